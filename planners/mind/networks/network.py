@@ -1,9 +1,9 @@
-import math
 import torch
-import numpy as np
+from collections import OrderedDict
 from torch import Tensor, nn
 from torch.nn import functional as F
-from torch.nn import MultiheadAttention, TransformerEncoderLayer, TransformerEncoder
+from torch.nn import TransformerEncoderLayer, TransformerEncoder
+from torch.nn.utils.rnn import pad_sequence
 from typing import Dict, List, Tuple, Optional
 from planners.mind.utils import gpu
 from planners.mind.networks.layers import Conv1d, Res1d
@@ -54,10 +54,35 @@ class ActorNet(nn.Module):
 
         out = self.lateral[-1](outputs[-1])
         for i in range(len(outputs) - 2, -1, -1):
-            out = F.interpolate(out, scale_factor=2, mode="linear", align_corners=False)
+            out = F.interpolate(out, size=outputs[i].shape[-1], mode="linear", align_corners=False)
             out += self.lateral[i](outputs[i])
 
-        out = self.output(out)[:, :, -1]
+        out = self._output_last(out)
+        return out
+
+    def _output_last(self, x: Tensor) -> Tensor:
+        '''
+            Equivalent to self.output(x)[:, :, -1]
+            GroupNorm statistics couple all timesteps, so conv1/conv2 run on the full sequence,
+            while the affine, residual and activation are applied to the last column only
+            x: (N, C, T)
+            out: (N, C)
+        '''
+        res = self.output
+        y = res.conv2(res.relu(res.bn1(res.conv1(x))))  # [N, C, T]
+
+        gn = res.bn2
+        n, c, _ = y.shape
+        var, mean = torch.var_mean(y.view(n, gn.num_groups, -1), dim=-1, unbiased=False)  # [N, G]
+        var = var.repeat_interleave(c // gn.num_groups, dim=1)
+        mean = mean.repeat_interleave(c // gn.num_groups, dim=1)
+        out = (y[:, :, -1] - mean) * torch.rsqrt(var + gn.eps)
+        if gn.affine:
+            out = out * gn.weight + gn.bias
+
+        out = out + x[:, :, -1]
+        if res.act:
+            out = F.relu(out)
         return out
 
 
@@ -85,16 +110,17 @@ class PointAggregateBlock(nn.Module):
         self.norm = nn.LayerNorm(hidden_size)
 
     def _global_maxpool_aggre(self, feat):
-        return F.adaptive_max_pool1d(feat.permute(0, 2, 1), 1).permute(0, 2, 1)
+        # [N, L, d] -> [N, 1, d]
+        return feat.amax(dim=1, keepdim=True)
 
     def forward(self, x_inp):
         x = self.fc1(x_inp)  # [N_{lane}, 10, hidden_size]
         x_aggre = self._global_maxpool_aggre(x)
-        x_aggre = torch.cat([x, x_aggre.repeat([1, x.shape[1], 1])], dim=-1)
+        x_aggre = torch.cat([x, x_aggre.expand(-1, x.shape[1], -1)], dim=-1)
 
         out = self.norm(x_inp + self.fc2(x_aggre))
         if self.aggre_out:
-            return self._global_maxpool_aggre(out).squeeze()
+            return out.amax(dim=1)  # [N_{lane}, hidden_size]
         else:
             return out
 
@@ -133,12 +159,14 @@ class RelaFusionLayer(nn.Module):
         super(RelaFusionLayer, self).__init__()
         self.device = device
         self.update_edge = update_edge
+        self.n_head = n_head
+        self.dropout_p = dropout
 
-        self.proj_memory = nn.Sequential(
-            nn.Linear(d_model + d_model + d_edge, d_model),
-            nn.LayerNorm(d_model),
-            nn.ReLU(inplace=True)
-        )
+        # memory projection of [edge, src, tar], split per operand so the node terms are projected before broadcasting
+        self.W_edge = nn.Linear(d_edge, d_model)
+        self.W_src = nn.Linear(d_model, d_model, bias=False)
+        self.W_tar = nn.Linear(d_model, d_model, bias=False)
+        self.mem_ln = nn.LayerNorm(d_model)
 
         if self.update_edge:
             self.proj_edge = nn.Sequential(
@@ -148,8 +176,11 @@ class RelaFusionLayer(nn.Module):
             )
             self.norm_edge = nn.LayerNorm(d_edge)
 
-        self.multihead_attn = MultiheadAttention(
-            embed_dim=d_model, num_heads=n_head, dropout=dropout, batch_first=False)
+        # multihead attention, projections are explicit so that the fused sdpa kernel can be used
+        self.q_proj = nn.Linear(d_model, d_model)
+        self.k_proj = nn.Linear(d_model, d_model)
+        self.v_proj = nn.Linear(d_model, d_model)
+        self.out_proj = nn.Linear(d_model, d_model)
 
         # Feedforward model
         self.linear1 = nn.Linear(d_model, d_ffn)
@@ -165,17 +196,18 @@ class RelaFusionLayer(nn.Module):
     def forward(self,
                 node: Tensor,
                 edge: Tensor,
-                edge_mask: Optional[Tensor]) -> Tensor:
+                attn_bias: Optional[Tensor]) -> Tensor:
         '''
             input:
-                node:       (N, d_model)
-                edge:       (N, N, d_model)
-                edge_mask:  (N, N)
+                node:       (B, N, d_model)
+                edge:       (B, N, N, d_model)
+                attn_bias:  (B*N, 1, 1, N), additive key padding mask, see RelaFusionNet.get_attn_bias
+            the leading batch dim B is optional
         '''
         # update node
         x, edge, memory = self._build_memory(node, edge)
-        x_prime, _ = self._mha_block(x, memory, attn_mask=None, key_padding_mask=edge_mask)
-        x = self.norm2(x + x_prime).squeeze()
+        x_prime, _ = self._mha_block(x, memory, attn_bias=attn_bias)
+        x = self.norm2(x + x_prime)
         x = self.norm3(x + self._ff_block(x))
         return x, edge, None
 
@@ -184,46 +216,54 @@ class RelaFusionLayer(nn.Module):
                       edge: Tensor) -> Tuple[Tensor, Tensor, Tensor]:
         '''
             input:
-                node:   (N, d_model)
-                edge:   (N, N, d_edge)
+                node:   (B, N, d_model)
+                edge:   (B, N, N, d_edge)
             output:
-                :param  (1, N, d_model)
-                :param  (N, N, d_edge)
-                :param  (N, N, d_model)
+                :param  (B, N, d_model)
+                :param  (B, N, N, d_edge)
+                :param  (B, N, N, d_model)
         '''
-        n_token = node.shape[0]
-
         # 1. build memory
-        src_x = node.unsqueeze(dim=0).repeat([n_token, 1, 1])  # (N, N, d_model)
-        tar_x = node.unsqueeze(dim=1).repeat([1, n_token, 1])  # (N, N, d_model)
-        memory = self.proj_memory(torch.cat([edge, src_x, tar_x], dim=-1))  # (N, N, d_model)
+        src_x = self.W_src(node)  # (B, N, d_model)
+        tar_x = self.W_tar(node)  # (B, N, d_model)
+        memory = self.W_edge(edge) + src_x.unsqueeze(dim=-3) + tar_x.unsqueeze(dim=-2)  # (B, N, N, d_model)
+        memory = F.relu(self.mem_ln(memory), inplace=True)
         # 2. (optional) update edge (with residual)
         if self.update_edge:
-            edge = self.norm_edge(edge + self.proj_edge(memory))  # (N, N, d_edge)
+            edge = self.norm_edge(edge + self.proj_edge(memory))  # (B, N, N, d_edge)
 
-        return node.unsqueeze(dim=0), edge, memory
+        return node, edge, memory
 
     # multihead attention block
     def _mha_block(self,
                    x: Tensor,
                    mem: Tensor,
-                   attn_mask: Optional[Tensor],
-                   key_padding_mask: Optional[Tensor]) -> Tensor:
+                   attn_bias: Optional[Tensor]) -> Tensor:
         '''
             input:
-                x:                  [1, N, d_model]
-                mem:                [N, N, d_model]
-                attn_mask:          [N, N]
-                key_padding_mask:   [N, N]
+                x:          [B, N, d_model]
+                mem:        [B, N, N, d_model], mem[:, j, i] is the memory of key j for target i
+                attn_bias:  [B*N, 1, 1, N]
             output:
-                :param      [1, N, d_model]
-                :param      [N, N]
+                :param      [B, N, d_model]
+                :param      None
         '''
-        x, _ = self.multihead_attn(x, mem, mem,
-                                   attn_mask=attn_mask,
-                                   key_padding_mask=key_padding_mask,
-                                   need_weights=False)  # return average attention weights
-        return self.dropout2(x), None
+        n_token, d_model = mem.shape[-2], mem.shape[-1]
+        d_head = d_model // self.n_head
+
+        # each target node is one batch entry with a single query over its N memory slots
+        mem = mem.transpose(-3, -2)
+        q = self.q_proj(x).view(-1, 1, self.n_head, d_head).transpose(1, 2)  # [B*N, n_head, 1, d_head]
+        k = self.k_proj(mem).reshape(-1, n_token, self.n_head, d_head).transpose(1, 2)  # [B*N, n_head, N, d_head]
+        v = self.v_proj(mem).reshape(-1, n_token, self.n_head, d_head).transpose(1, 2)  # [B*N, n_head, N, d_head]
+
+        if attn_bias is not None:
+            attn_bias = attn_bias.to(q.dtype)  # no-op unless running under autocast
+
+        out = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_bias,
+                                             dropout_p=self.dropout_p if self.training else 0.0)
+        out = self.out_proj(out.transpose(1, 2).reshape(x.shape))
+        return self.dropout2(out), None
 
     # feed forward block
     def _ff_block(self,
@@ -231,6 +271,32 @@ class RelaFusionLayer(nn.Module):
         x = self.linear2(self.dropout(self.activation(self.linear1(x))))
         return self.dropout3(x)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints with a single memory projection over the concatenated [edge, src, tar] features
+        w_mem = state_dict.pop(prefix + 'proj_memory.0.weight', None)
+        if w_mem is not None:
+            d_edge = self.W_edge.in_features
+            d_model = self.W_src.in_features
+            state_dict[prefix + 'W_edge.weight'] = w_mem[:, :d_edge]
+            state_dict[prefix + 'W_src.weight'] = w_mem[:, d_edge:d_edge + d_model]
+            state_dict[prefix + 'W_tar.weight'] = w_mem[:, d_edge + d_model:]
+        for src, dst in [('proj_memory.0.bias', 'W_edge.bias'),
+                         ('proj_memory.1.weight', 'mem_ln.weight'),
+                         ('proj_memory.1.bias', 'mem_ln.bias')]:
+            if prefix + src in state_dict:
+                state_dict[prefix + dst] = state_dict.pop(prefix + src)
+
+        # checkpoints trained with nn.MultiheadAttention pack q/k/v into a single input projection
+        mha = prefix + 'multihead_attn.'
+        for p in ['weight', 'bias']:
+            packed = state_dict.pop(mha + 'in_proj_' + p, None)
+            if packed is not None:
+                for name, chunk in zip(['q_proj', 'k_proj', 'v_proj'], packed.chunk(3)):
+                    state_dict[prefix + name + '.' + p] = chunk
+            if mha + 'out_proj.' + p in state_dict:
+                state_dict[prefix + 'out_proj.' + p] = state_dict.pop(mha + 'out_proj.' + p)
+        super(RelaFusionLayer, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
 
 class RelaFusionNet(nn.Module):
     def __init__(self,
@@ -256,17 +322,32 @@ class RelaFusionNet(nn.Module):
                                           update_edge=need_update_edge))
         self.fusion = nn.ModuleList(fusion)
 
-    def forward(self, x: Tensor, edge: Tensor, edge_mask: Tensor) -> Tensor:
+    def forward(self, x: Tensor, edge: Tensor, edge_mask: Optional[Tensor]) -> Tensor:
         '''
-            x: (N, d_model)
-            edge: (d_model, N, N)
-            edge_mask: (N, N)
+            x: (B, N, d_model)
+            edge: (B, N, N, d_edge)
+            edge_mask: (B, N, N), or broadcastable to it
         '''
+        # the padding mask is the same for all layers, build the attention bias once
+        attn_bias = self.get_attn_bias(edge_mask, x) if edge_mask is not None else None
         # attn_multilayer = []
         for mod in self.fusion:
-            x, edge, _ = mod(x, edge, edge_mask)
+            x, edge, _ = mod(x, edge, attn_bias)
         return x, None
 
+    @staticmethod
+    def get_attn_bias(edge_mask: Tensor, x: Tensor) -> Tensor:
+        '''
+            edge_mask: (B, N, N), or broadcastable to it, True for keys that are ignored
+            x: (B, N, d_model)
+            output: (B*N, 1, 1, N), one row per target node
+            an additive float mask keeps the fused sdpa kernels eligible (boolean masks fall back to the math path)
+        '''
+        n_token = x.shape[-2]
+        attn_bias = torch.zeros(edge_mask.shape, dtype=x.dtype, device=x.device)
+        attn_bias = attn_bias.masked_fill_(edge_mask, float('-inf'))
+        return attn_bias.expand(*x.shape[:-2], n_token, n_token).reshape(-1, 1, 1, n_token)
+
 
 class FusionNet(nn.Module):
     def __init__(self, device, config):
@@ -322,6 +403,11 @@ class FusionNet(nn.Module):
                                         dropout=dropout,
                                         update_edge=update_edge)
 
+        # 可选：逐层编译，使FFN与LayerNorm/残差中的逐元素算子融合为少量kernel, token数N按动态维度处理
+        if config.get('compile', False):
+            for mod in self.fuse_scene.fusion:
+                mod.compile(mode="reduce-overhead", dynamic=True)
+
     def forward(self,
                 actors: Tensor,
                 actor_idcs: List[Tensor],
@@ -336,51 +422,44 @@ class FusionNet(nn.Module):
         :param lanes: 输入的车道数据张量
         :param lane_idcs: 车道数据的索引列表
         :param rpe_prep: 相对位置嵌入的预处理数据字典
-        :return: 处理后的演员数据、车道数据和分类信息
+        :return: 处理后的演员数据 [B, A_max, d_model] (按样本补齐, 第i个样本只有前n_actors[i]行有效)、
+                 每个样本的车道数据列表和分类信息 [B, d_model]
         """
         # 对演员和车道数据进行投影
         actors = self.proj_actor(actors)
         lanes = self.proj_lane(lanes)
 
-        # 初始化新的数据列表
-        actors_new, lanes_new, cls_new = list(), list(), list()
-
-        # 遍历每个样本的演员和车道数据，进行融合处理
-        for a_idcs, l_idcs, rpes in zip(actor_idcs, lane_idcs, rpe_prep):
-            # 获取当前样本的演员和车道数据
-            _actors = actors[a_idcs]
-            _lanes = lanes[l_idcs]
-            # 将演员和车道数据合并，完全是SIMPL的架构
-            tokens = torch.cat([_actors, _lanes], dim=0)
-
-            # 创建CLS标记(Classification Token)，并将其添加到合并的数据中, 此处借鉴BERT的架构
-            # CLS标记是一个额外的输入标记，用于帮助模型学习整个输入序列的全局特征，通常用于分类任务
-            cls_token = torch.zeros((1, self.d_model), device=self.device)
-            tokens_with_cls = torch.cat([tokens, cls_token], dim=0)
-
-            # 对相对位置嵌入进行投影，并调整形状
-            rpe = self.proj_rpe_scene(rpes['scene'].permute(1, 2, 0))
-            # 创建包含CLS的相对位置嵌入矩阵
-            # 这段代码的主要目的是扩展相对位置编码（Relative Positional Encoding, RPE）以包含CLS标记，因为：
-            # 1. 在序列tokens中加入CLS标记后，整个序列tokens_with_cls的长度变长了。
-            # 2. 相对位置编码也需要相应地扩展，以包含CLS标记的位置信息。
-            rpe_with_cls = torch.zeros(
-                (tokens_with_cls.shape[0], tokens_with_cls.shape[0], self.d_rpe),
-                device=self.device)
-            rpe_with_cls[:tokens.shape[0], :tokens.shape[0], :] = rpe
-
-            # 使用融合模块处理数据和相对位置嵌入
-            out, _ = self.fuse_scene(tokens_with_cls, rpe_with_cls, edge_mask=None)
-
-            # 将处理结果分别添加到对应的列表中
-            actors_new.append(out[:len(a_idcs)])
-            lanes_new.append(out[len(a_idcs):-1])
-            cls_new.append(out[-1].unsqueeze(0))
-
-        # 将所有样本的数据合并
-        actors = torch.cat(actors_new, dim=0)
-        lanes = torch.cat(lanes_new, dim=0)
-        cls = torch.cat(cls_new, dim=0)
+        # 将所有样本补齐到最大的场景后一次性融合，每个样本的token顺序为 [actors, lanes, cls, padding]
+        # CLS标记(Classification Token)借鉴BERT的架构，用于学习整个场景的全局特征，其与padding的RPE均为0
+        n_actors = [len(a_idcs) for a_idcs in actor_idcs]
+        n_tokens = [len(a_idcs) + len(l_idcs) for a_idcs, l_idcs in zip(actor_idcs, lane_idcs)]
+        batch_size, n_max = len(n_tokens), max(n_tokens) + 1
+
+        # token补齐到n_max, 末尾多出的一位留给CLS (pad_sequence只补齐到max(n_tokens))
+        tokens = pad_sequence([torch.cat([actors[a_idcs], lanes[l_idcs]], dim=0)
+                               for a_idcs, l_idcs in zip(actor_idcs, lane_idcs)], batch_first=True)
+        tokens = F.pad(tokens, (0, 0, 0, 1))  # [B, n_max, d_model]
+
+        # 原始RPE先用F.pad补齐后整体投影一次，再把CLS和padding对应的行列置0
+        rpe = torch.stack([F.pad(rpes['scene'], (0, n_max - n_tok, 0, n_max - n_tok))
+                           for rpes, n_tok in zip(rpe_prep, n_tokens)], dim=0)  # [B, d_rpe_in, n_max, n_max]
+        rpe = self.proj_rpe_scene(rpe.permute(0, 2, 3, 1))  # [B, n_max, n_max, d_rpe]
+        tok_valid = pad_sequence([torch.ones(n_tok, dtype=torch.bool, device=self.device) for n_tok in n_tokens],
+                                 batch_first=True)
+        tok_valid = F.pad(tok_valid, (0, n_max - tok_valid.shape[1]))  # [B, n_max]
+        rpe = rpe.masked_fill(~(tok_valid.unsqueeze(1) & tok_valid.unsqueeze(2)).unsqueeze(-1), 0.0)
+        # CLS紧跟在最后一个有效token之后, 它和有效token都参与attention
+        pad_mask = ~(tok_valid | F.pad(tok_valid, (1, 0))[:, :-1])
+
+        # 使用融合模块处理数据和相对位置嵌入，只有存在padding时才需要mask
+        edge_mask = pad_mask.unsqueeze(1) if min(n_tokens) < max(n_tokens) else None
+        out, _ = self.fuse_scene(tokens, rpe, edge_mask=edge_mask)
+
+        # 从补齐后的结果中取回每个样本的演员、车道和CLS, 演员和车道直接使用视图而不再拷贝拼接
+        # 演员位于每个样本的最前面, out[:, :A_max]中超出n_actors[i]的行属于其他token, 由解码器切片丢弃
+        actors = out[:, :max(n_actors)]
+        lanes = [out[i, n_actors[i]:n_tokens[i]] for i in range(batch_size)]
+        cls = out[torch.arange(batch_size, device=self.device), tok_valid.sum(dim=1)]
 
         return actors, lanes, cls
 
@@ -469,8 +548,11 @@ class SceneDecoder(nn.Module):
         # 根据param_out参数初始化回归器
         if self.param_out == 'bezier':
             self.N_ORDER = 7
-            self.mat_T = self._get_T_matrix_bezier(n_order=self.N_ORDER, n_step=future_steps).to(self.device)
-            self.mat_Tp = self._get_Tp_matrix_bezier(n_order=self.N_ORDER, n_step=future_steps).to(self.device)
+            self.register_buffer('mat_T', self._get_T_matrix_bezier(n_order=self.N_ORDER, n_step=future_steps),
+                                 persistent=False)
+            # 差分矩阵预先乘入导数基矩阵: mat_Tp @ diff(p) == (mat_Tp @ D) @ p
+            self.register_buffer('mat_Tp_D', self._get_Tp_matrix_bezier(n_order=self.N_ORDER, n_step=future_steps) @
+                                 self._get_diff_matrix(self.N_ORDER + 1), persistent=False)
             self.reg = nn.Sequential(
                 nn.Linear(self.hidden_size, self.hidden_size),
                 nn.LayerNorm(self.hidden_size),
@@ -482,8 +564,11 @@ class SceneDecoder(nn.Module):
             )
         elif self.param_out == 'monomial':
             self.N_ORDER = 7
-            self.mat_T = self._get_T_matrix_monomial(n_order=self.N_ORDER, n_step=future_steps).to(self.device)
-            self.mat_Tp = self._get_Tp_matrix_monomial(n_order=self.N_ORDER, n_step=future_steps).to(self.device)
+            self.register_buffer('mat_T', self._get_T_matrix_monomial(n_order=self.N_ORDER, n_step=future_steps),
+                                 persistent=False)
+            self.register_buffer('mat_Tp', self._get_Tp_matrix_monomial(n_order=self.N_ORDER, n_step=future_steps),
+                                 persistent=False)
+            self.register_buffer('mat_Tp_D', self.mat_Tp @ self._get_diff_matrix(self.N_ORDER + 1), persistent=False)
             self.reg = nn.Sequential(
                 nn.Linear(self.hidden_size, self.hidden_size),
                 nn.LayerNorm(self.hidden_size),
@@ -494,6 +579,7 @@ class SceneDecoder(nn.Module):
                 nn.Linear(self.hidden_size, (self.N_ORDER + 1) * 5)
             )
         elif self.param_out == 'none':
+            self.register_buffer('mat_grad', self._get_grad_matrix(future_steps), persistent=False)
             self.reg = nn.Sequential(
                 nn.Linear(self.hidden_size, self.hidden_size),
                 nn.LayerNorm(self.hidden_size),
@@ -506,39 +592,58 @@ class SceneDecoder(nn.Module):
         else:
             raise NotImplementedError
 
+    @staticmethod
+    def _get_binomial(n):
+        # C(n, i) for i = 0..n, by the recurrence C(n, i + 1) = C(n, i) * (n - i) / (i + 1)
+        i = torch.arange(n, dtype=torch.float64)
+        ratio = (n - i) / (i + 1)
+        return torch.cat([torch.ones(1, dtype=torch.float64), torch.cumprod(ratio, dim=0)]).round()
+
+    @staticmethod
+    def _get_diff_matrix(n):
+        # D @ x == torch.diff(x, dim=-2), [n - 1, n]
+        D = torch.zeros(n - 1, n)
+        idx = torch.arange(n - 1)
+        D[idx, idx] = -1.0
+        D[idx, idx + 1] = 1.0
+        return D
+
+    @staticmethod
+    def _get_grad_matrix(n):
+        # G @ x == torch.gradient(x, dim=-2)[0] (unit spacing, edge_order=1), [n, n]
+        G = torch.zeros(n, n)
+        idx = torch.arange(1, n - 1)
+        G[idx, idx - 1] = -0.5
+        G[idx, idx + 1] = 0.5
+        G[0, 0], G[0, 1] = -1.0, 1.0
+        G[n - 1, n - 2], G[n - 1, n - 1] = -1.0, 1.0
+        return G
+
     def _get_T_matrix_bezier(self, n_order, n_step):
-        ts = np.linspace(0.0, 1.0, n_step, endpoint=True)
-        T = []
-        for i in range(n_order + 1):
-            coeff = math.comb(n_order, i) * (1.0 - ts) ** (n_order - i) * ts ** i
-            T.append(coeff)
-        return torch.Tensor(np.array(T).T)
+        ts = torch.linspace(0.0, 1.0, n_step, dtype=torch.float64).unsqueeze(1)
+        i = torch.arange(n_order + 1, dtype=torch.float64)
+        T = self._get_binomial(n_order) * (1.0 - ts) ** (n_order - i) * ts ** i
+        return T.float().contiguous()
 
     def _get_Tp_matrix_bezier(self, n_order, n_step):
         # ~ 1st derivatives
-        ts = np.linspace(0.0, 1.0, n_step, endpoint=True)
-        Tp = []
-        for i in range(n_order):
-            coeff = n_order * math.comb(n_order - 1, i) * (1.0 - ts) ** (n_order - 1 - i) * ts ** i
-            Tp.append(coeff)
-        return torch.Tensor(np.array(Tp).T)
+        ts = torch.linspace(0.0, 1.0, n_step, dtype=torch.float64).unsqueeze(1)
+        i = torch.arange(n_order, dtype=torch.float64)
+        Tp = n_order * self._get_binomial(n_order - 1) * (1.0 - ts) ** (n_order - 1 - i) * ts ** i
+        return Tp.float().contiguous()
 
     def _get_T_matrix_monomial(self, n_order, n_step):
-        ts = np.linspace(0.0, 1.0, n_step, endpoint=True)
-        T = []
-        for i in range(n_order + 1):
-            coeff = ts ** i
-            T.append(coeff)
-        return torch.Tensor(np.array(T).T)
+        ts = torch.linspace(0.0, 1.0, n_step, dtype=torch.float64).unsqueeze(1)
+        i = torch.arange(n_order + 1, dtype=torch.float64)
+        T = ts ** i
+        return T.float().contiguous()
 
     def _get_Tp_matrix_monomial(self, n_order, n_step):
         # ~ 1st derivatives
-        ts = np.linspace(0.0, 1.0, n_step, endpoint=True)
-        Tp = []
-        for i in range(n_order):
-            coeff = (i + 1) * (ts ** i)
-            Tp.append(coeff)
-        return torch.Tensor(np.array(Tp).T)
+        ts = torch.linspace(0.0, 1.0, n_step, dtype=torch.float64).unsqueeze(1)
+        i = torch.arange(n_order, dtype=torch.float64)
+        Tp = (i + 1) * ts ** i
+        return Tp.float().contiguous()
 
     def forward(self,
                 ctx: torch.Tensor,  # 交通上下文特征
@@ -551,7 +656,7 @@ class SceneDecoder(nn.Module):
 
         参数:
         - ctx: 交通上下文特征，类型为torch.Tensor
-        - actors: agent特征，类型为torch.Tensor
+        - actors: 按样本补齐的agent特征 [B, A_max, hidden_size]，类型为torch.Tensor
         - actor_idcs: agent索引列表，类型为List[Tensor]
         - tgt_feat: 目标特征，类型为torch.Tensor
         - tgt_rpes: 目标相对于位置的嵌入，类型为torch.Tensor
@@ -561,92 +666,68 @@ class SceneDecoder(nn.Module):
         - res_reg: 回归结果列表
         - res_aux: 辅助结果列表
         """
-        res_cls, res_reg, res_aux = [], [], []
         # 对目标相对于位置的嵌入进行投影:high-level commands的target node
         tgt_rpes = self.proj_rpe(tgt_rpes)  # [n_av, 128]
-        # 如果目标特征维度为1，增加一个维度
-        if len(tgt_feat.shape) == 1:
-            tgt_feat = tgt_feat.unsqueeze(0)
-
         # 对目标特征和相对位置嵌入的组合进行投影
-        tgt = self.proj_tgt(torch.cat([tgt_feat, tgt_rpes], dim=-1))
+        tgt = self.proj_tgt(torch.cat([tgt_feat, tgt_rpes], dim=-1))  # [B, hidden_size]
 
-        # 遍历每个agent索引，进行特征嵌入和预测
-        for idx, a_idcs in enumerate(actor_idcs):
-            _ctx = ctx[idx].unsqueeze(0)    # 获取当前交通上下文并调整维度
-            _actors = actors[a_idcs]    # 获取当前agent特征
+        # agent已按样本补齐到A_max, 一次性完成所有样本的嵌入和预测
+        batch_size = len(actor_idcs)
+        n_actors = [len(a_idcs) for a_idcs in actor_idcs]
 
-            # 对交通上下文进行投影并调整维度，然后进行饱和处理
-            cls_embed = self.ctx_proj(_ctx).view(-1, self.num_modes, self.hidden_size).permute(1, 0, 2)
-            cls_embed = self.ctx_sat(cls_embed)
+        # 对交通上下文进行投影并调整维度，然后进行饱和处理
+        cls_embed = self.ctx_proj(ctx).view(batch_size, self.num_modes, self.hidden_size).permute(1, 0, 2)
+        cls_embed = self.ctx_sat(cls_embed).permute(1, 0, 2)  # [B, num_modes, hidden_size]
 
-            # 对agent特征进行投影并调整维度
-            actor_embed = self.actor_proj(_actors).view(-1, self.num_modes, self.hidden_size).permute(1, 0, 2)
+        # 对agent特征进行投影并调整维度
+        actor_embed = self.actor_proj(actors).view(batch_size, -1, self.num_modes, self.hidden_size)
 
-            # 初始化目标嵌入，并将第一个目标嵌入设置为投影后的目标特征
-            # 猜测：high-level commands的target node
-            tgt_embed = torch.zeros_like(actor_embed)
-            tgt_embed[0] = tgt[idx].unsqueeze(0)
+        # 目标嵌入只加在第一个模态上, 猜测：high-level commands的target node
+        tgt_embed = F.pad(tgt.unsqueeze(1), (0, 0, 0, self.num_modes - 1))  # [B, num_modes, hidden_size]
 
-            # 结合交通上下文、agent和目标嵌入，进行分类和回归预测
-            embed = cls_embed + actor_embed + tgt_embed
-            cls = self.cls(cls_embed).view(self.num_modes, -1)
+        # 结合交通上下文、agent和目标嵌入，进行分类和回归预测
+        embed = actor_embed + (cls_embed + tgt_embed).unsqueeze(1)  # [B, A_max, num_modes, hidden_size]
+        cls = self.cls(cls_embed).view(batch_size, self.num_modes)
 
-            # 根据不同的输出参数，计算回归参数、速度和协方差
+        # 根据不同的输出参数，计算回归参数、速度和协方差
+        # 回归头可以在混合精度下运行，基矩阵乘法则在fp32下计算, 保证轨迹输出的精度和dtype不变
+        param = self.reg(embed).float()
+        with torch.autocast(device_type=embed.device.type, enabled=False):
             if self.param_out == 'bezier':
-                # 通过 self.reg 层处理 embed 向量，然后将其重塑为形状 (num_modes, -1, N_ORDER + 1, 5) 的张量
                 # param 包含了不同模式下的贝塞尔曲线参数，每个模式有 N_ORDER + 1 个控制点，每个控制点有 5 个参数
-                param = self.reg(embed).view(self.num_modes, -1, self.N_ORDER + 1, 5)
-
-                # 作用：提取 param 中前两个维度的数据，即位置参数，并重新排列维度顺序。
-                # 物理意义：reg_param 包含了位置参数，每个控制点有 2 个位置坐标。
-                reg_param = param[..., :2]
-                reg_param = reg_param.permute(1, 0, 2, 3)
+                param = param.view(batch_size, -1, self.num_modes, self.N_ORDER + 1, 5)
 
+                # 位置参数(前2维)和协方差参数(后3维)共用同一组基矩阵，一次矩阵乘法同时得到两者
+                traj = torch.matmul(self.mat_T, param)
+                traj_vel = torch.matmul(self.mat_Tp_D, param) / (self.future_steps * 0.1)
                 # reg 可以被看作是未来位置的一个预测或表示
-                reg = torch.matmul(self.mat_T, reg_param)   # 矩阵乘法 torch.matmu
-                vel = torch.matmul(self.mat_Tp, torch.diff(reg_param, dim=2)) / (self.future_steps * 0.1)   # 通过矩阵乘法 torch.matmul 和差分 torch.diff 计算速度 vel
-
-                # 作用：提取 param 中从第三个维度开始的数据，即协方差参数，并重新排列维度顺序。
-                # 物理意义：cov_param 包含了协方差参数，每个控制点有 3 个协方差参数
-                cov_param = param[..., 2:]
-                cov_param = cov_param.permute(1, 0, 2, 3)
-
-                # 计算 协方差cov 和 协方差速度cov_vel
-                cov = torch.matmul(self.mat_T, cov_param)
-                cov_vel = torch.matmul(self.mat_Tp, torch.diff(cov_param, dim=2)) / (self.future_steps * 0.1)
+                reg, cov = traj[..., :2], traj[..., 2:]
+                vel, cov_vel = traj_vel[..., :2], traj_vel[..., 2:]
 
             elif self.param_out == 'monomial':
-                param = self.reg(embed).view(self.num_modes, -1, self.N_ORDER + 1, 5)
-                reg_param = param[..., :2]
-                reg_param = reg_param.permute(1, 0, 2, 3)
-                reg = torch.matmul(self.mat_T, reg_param)
-                vel = torch.matmul(self.mat_Tp, reg_param[:, :, 1:, :]) / (self.future_steps * 0.1)
-                cov_param = param[..., 2:]
-                cov_param = cov_param.permute(1, 0, 2, 3)
-                cov = torch.matmul(self.mat_T, cov_param)
-                cov_vel = torch.matmul(self.mat_Tp, torch.diff(cov_param, dim=2)) / (self.future_steps * 0.1)
+                param = param.view(batch_size, -1, self.num_modes, self.N_ORDER + 1, 5)
+                traj = torch.matmul(self.mat_T, param)
+                reg, cov = traj[..., :2], traj[..., 2:]
+                vel = torch.matmul(self.mat_Tp, param[..., 1:, :2]) / (self.future_steps * 0.1)
+                cov_vel = torch.matmul(self.mat_Tp_D, param[..., 2:]) / (self.future_steps * 0.1)
 
             elif self.param_out == 'none':
-                param = self.reg(embed).view(self.num_modes, -1, self.N_ORDER + 1, 5)
-                reg = param[..., :2]
-                reg = reg.permute(1, 0, 2, 3)
-                vel = torch.gradient(reg, dim=-2)[0] / 0.1
-                cov = param[..., 2:]
-                cov = cov.permute(1, 0, 2, 3)
-                cov_vel = torch.gradient(cov, dim=-2)[0] / 0.1
-
-            # 将回归结果和辅助信息组合并存储
+                param = param.view(batch_size, -1, self.num_modes, self.future_steps, 5)
+                reg, cov = param[..., :2], param[..., 2:]
+                traj_vel = torch.matmul(self.mat_grad, param) / 0.1
+                vel, cov_vel = traj_vel[..., :2], traj_vel[..., 2:]
+
+            # 将回归结果和辅助信息组合, reg: [B, A_max, num_modes, future_steps, 5]
             reg = torch.cat([reg, torch.exp(cov)], dim=-1)
+        cls = F.softmax(cls.float() * 1.0, dim=1)
 
-            cls = cls.permute(1, 0)
-            cls = F.softmax(cls * 1.0, dim=1)
-            res_cls.append(cls)
-            res_reg.append(reg)
-            if self.param_out == 'none':
-                res_aux.append((vel, cov_vel, None))  # ! None is a placeholder
-            else:
-                res_aux.append((vel, cov_vel, param))
+        # 按样本切片去掉padding的agent
+        res_cls = [cls[i:i + 1] for i in range(batch_size)]
+        res_reg = [reg[i, :n] for i, n in enumerate(n_actors)]
+        if self.param_out == 'none':
+            res_aux = [(vel[i, :n], cov_vel[i, :n], None) for i, n in enumerate(n_actors)]  # ! None is a placeholder
+        else:
+            res_aux = [(vel[i, :n], cov_vel[i, :n], param[i, :n].transpose(0, 1)) for i, n in enumerate(n_actors)]
 
         # res_cls：表示对于每个模式（mode）的分类概率。具体来说，它包含了模型对不同未来轨迹模式的概率分布估计。这些概率可以用来评估不同预测路径的可能性大小，帮助决策系统选择最有可能的未来轨迹
         # res_reg：表示对于每个预测模式的具体轨迹参数。这些参数描述了预测轨迹的具体形状或位置信息，例如位置坐标、速度等。根据不同的 param_out 设置，回归结果可能包含贝塞尔曲线参数、多项式系数或其他形式的轨迹描述
@@ -681,6 +762,20 @@ class ScenePredNet(nn.Module):
                                        future_steps=cfg['g_pred_len'],
                                        num_modes=cfg['g_num_modes'])
 
+        # 可选：使用torch.compile融合车道编码器和解码器中的 Linear/LayerNorm/ReLU 链 (需要 torch >= 2.2)
+        # 车道数N_lane随场景变化 (lane_net还会用于目标节点), 因此按动态形状编译
+        if cfg.get('compile', False):
+            self.lane_net.compile(mode="reduce-overhead", dynamic=True)
+            self.pred_scene.compile(mode="reduce-overhead", dynamic=True)
+
+        # 可选：融合和解码部分使用bf16混合精度 (LayerNorm/softmax由autocast保持fp32)
+        self.use_amp = cfg.get('use_amp', False)
+
+        # 可选：推理时按输入形状捕获CUDA Graph并重放, 与torch.compile的reduce-overhead模式互斥
+        self.use_cuda_graph = cfg.get('cuda_graph', False) and not cfg.get('compile', False)
+        self.max_cuda_graphs = cfg.get('max_cuda_graphs', 8)
+        self._cuda_graphs = OrderedDict()
+
     def forward(self, data):
         """
         前向传播函数，用于处理输入数据并生成预测结果。
@@ -698,7 +793,12 @@ class ScenePredNet(nn.Module):
         返回:
         - out: 预测的场景图模型输出
         """
+        if self.use_cuda_graph and not self.training and data[0].is_cuda \
+                and not torch.cuda.is_current_stream_capturing():
+            return self._forward_graphed(data)
+        return self._forward(data)
 
+    def _forward(self, data):
         # 解包输入数据
         actors, actor_idcs, lanes, lane_idcs, rpe, tgt_nodes, tgt_rpe = data
 
@@ -707,20 +807,84 @@ class ScenePredNet(nn.Module):
         lanes = self.lane_net(lanes)  # output: [N_{lane}, 128]
         # tgt encode, 这东西是high-level commands的出来的Target node
         tgt_feat = self.lane_net(tgt_nodes)  # output: [1, 128]
-        # * fusion
-        actors, lanes, cls = self.fusion_net(actors, actor_idcs, lanes, lane_idcs, rpe)
-        # * decoding
-        out = self.pred_scene(cls, actors, actor_idcs, tgt_feat, tgt_rpe)
+        with torch.autocast(device_type=actors.device.type, dtype=torch.bfloat16, enabled=self.use_amp):
+            # * fusion
+            actors, lanes, cls = self.fusion_net(actors, actor_idcs, lanes, lane_idcs, rpe)
+            # * decoding
+            out = self.pred_scene(cls, actors, actor_idcs, tgt_feat, tgt_rpe)
 
         return out
 
+    @torch.no_grad()
+    def _forward_graphed(self, data):
+        '''
+            Replay a CUDA graph captured for inputs with the same shapes and dtypes
+            A new graph is captured on the first call of each signature, the least recently used one is evicted
+        '''
+        key = self._graph_signature(data)
+        if key in self._cuda_graphs:
+            self._cuda_graphs.move_to_end(key)
+        else:
+            self._cuda_graphs[key] = self._capture_cuda_graph(data)
+            if len(self._cuda_graphs) > self.max_cuda_graphs:
+                self._cuda_graphs.popitem(last=False)
+        graph, static_inputs, static_outputs = self._cuda_graphs[key]
+
+        for dst, src in zip(self._graph_leaves(static_inputs), self._graph_leaves(data)):
+            dst.copy_(src, non_blocking=True)
+        graph.replay()
+        return self._graph_map(static_outputs, lambda x: x.clone())
+
+    def _capture_cuda_graph(self, data):
+        static_inputs = self._graph_map(data, lambda x: x.clone())
+
+        # warm up on a side stream so that lazy initializations are not captured
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                self._forward(static_inputs)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            static_outputs = self._forward(static_inputs)
+        return graph, static_inputs, static_outputs
+
+    @staticmethod
+    def _graph_signature(data):
+        if isinstance(data, list) or isinstance(data, tuple):
+            return tuple(ScenePredNet._graph_signature(x) for x in data)
+        elif isinstance(data, dict):
+            return tuple((key, ScenePredNet._graph_signature(_data)) for key, _data in data.items())
+        elif isinstance(data, torch.Tensor):
+            return tuple(data.shape), data.dtype
+        return data
+
+    @staticmethod
+    def _graph_leaves(data):
+        if isinstance(data, list) or isinstance(data, tuple):
+            return [leaf for x in data for leaf in ScenePredNet._graph_leaves(x)]
+        elif isinstance(data, dict):
+            return [leaf for _data in data.values() for leaf in ScenePredNet._graph_leaves(_data)]
+        elif isinstance(data, torch.Tensor):
+            return [data]
+        return []
+
+    @staticmethod
+    def _graph_map(data, fn):
+        if isinstance(data, list) or isinstance(data, tuple):
+            return type(data)(ScenePredNet._graph_map(x, fn) for x in data)
+        elif isinstance(data, dict):
+            return {key: ScenePredNet._graph_map(_data, fn) for key, _data in data.items()}
+        elif isinstance(data, torch.Tensor):
+            return fn(data)
+        return data
+
     def pre_process(self, data):
-        actors = gpu(data['ACTORS'], self.device)
-        actor_idcs = gpu(data['ACTOR_IDCS'], self.device)
-        lanes = gpu(data['LANES'], self.device)
-        lane_idcs = gpu(data['LANE_IDCS'], self.device)
-        rpe = gpu(data['RPE'], self.device) # rpe: relative positional embedding
-        tgt_nodes = gpu(data['TGT_NODES'], self.device)
-        tgt_rpe = gpu(data['TGT_RPE'], self.device)
+        # transfer all inputs together so that each dtype needs a single H2D copy
+        keys = ['ACTORS', 'ACTOR_IDCS', 'LANES', 'LANE_IDCS', 'RPE', 'TGT_NODES', 'TGT_RPE']
+        actors, actor_idcs, lanes, lane_idcs, rpe, tgt_nodes, tgt_rpe = gpu([data[k] for k in keys], self.device)
+        # rpe: relative positional embedding
 
         return actors, actor_idcs, lanes, lane_idcs, rpe, tgt_nodes, tgt_rpe
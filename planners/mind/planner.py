@@ -43,6 +43,8 @@ class MINDPlanner:
     def init_device(self):
         if self.planner_cfg['use_cuda'] and torch.cuda.is_available():
             self.device = torch.device("cuda", 0)
+            # allow TF32 tensor cores for the fp32 matmuls of the prediction network
+            torch.set_float32_matmul_precision("high")
         else:
             self.device = torch.device('cpu')
 
@@ -72,6 +74,19 @@ class MINDPlanner:
         self.network = self.network.to(self.device)
         self.network.eval()
 
+        # optional int8 dynamic quantization of the Linear layers for CPU inference
+        if self.planner_cfg.get('quantize', False) and self.device.type == 'cpu':
+            self.network = self.quantize_network(self.network)
+
+    @staticmethod
+    def quantize_network(network):
+        # the attention projections are kept in fp32, quantizing them costs too much accuracy
+        attn_proj = ('q_proj', 'k_proj', 'v_proj', 'out_proj')
+        qconfig_spec = {name: torch.ao.quantization.default_dynamic_qconfig
+                        for name, module in network.named_modules()
+                        if isinstance(module, torch.nn.Linear) and name.split('.')[-1] not in attn_proj}
+        return torch.ao.quantization.quantize_dynamic(network, qconfig_spec, dtype=torch.qint8)
+
     def init_scen_tree_gen(self):
         scen_tree_cfg = import_module(self.planner_cfg['planning_config']).ScenTreeCfg()
         self.scen_tree_gen = ScenarioTreeGenerator(self.device, self.network, self.obs_len, self.plan_len, scen_tree_cfg)
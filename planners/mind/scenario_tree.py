@@ -1,10 +1,15 @@
-import copy
 import torch
 import numpy as np
+from collections import deque
 from planners.basic.tree import Tree, Node
-from planners.mind.utils import gpu, from_numpy, get_max_covariance, get_origin_rotation, get_new_lane_graph, \
+from planners.mind.utils import gpu, from_numpy, get_origin_rotation, get_new_lane_graph, \
     get_rpe, get_angle, collate_fn, get_agent_trajectories, update_lane_graph_from_argo, \
-    get_distance_to_polyline
+    get_distance_to_polyline_batched, get_origin_rotation_batched, build_rot2d, transform_scenes_to_global, to_numpy, \
+    greedy_topo_merge, get_tgt_nodes
+
+# the target lane window fed to the network: TGT_WIN points around the look-ahead point, i.e. TGT_WIN - 1 segments
+TGT_WIN = 11
+TGT_HALF_WIN = TGT_WIN // 2
 
 
 class ScenarioData:
@@ -28,9 +33,16 @@ class ScenarioTreeGenerator:
         self.lane_graph = None
         self.target_lane = None
         self.target_lane_info = None
+        self._target_lane_full = None
+        self._target_cumdist = None
         self.ego_idx = 0
         self.branch_depth = 0
 
+        # replay the network from CUDA graphs, one graph per input signature (mostly the batch size, since the
+        # agents and the lane graph stay the same within a tree). Only read the network's flag: it is already
+        # off when the network is compiled, since reduce-overhead captures its own graphs
+        self.use_cuda_graph = getattr(self.config, 'cuda_graph', False) and getattr(self.network, 'use_cuda_graph', False)
+
     def reset(self):
         self.branch_depth = 0
         self.tree = Tree()
@@ -55,8 +67,10 @@ class ScenarioTreeGenerator:
         branch_nodes = self.get_branch_set()
         while branch_nodes:
             # Batch Scenario Prediction: 收集当前分支节点的观察数据进行批量处理和预测
-            data_batch = collate_fn([node.data.obs_data for node in branch_nodes])
+            data_batch = collate_fn(self.pad_batch([node.data.obs_data for node in branch_nodes]))
             pred_batch = self.predict_scenes(data_batch)    # 通过网络模型进行场景预测
+            # 去掉补齐的样本
+            pred_batch = tuple(res[:len(branch_nodes)] for res in pred_batch)
 
             # Pruning & Merging: 根据预测结果，剪枝不可能的场景并合并相似的场景
             pred_bar = self.prune_merge(data_batch, pred_batch)
@@ -83,6 +97,21 @@ class ScenarioTreeGenerator:
         self.create_nodes(pred_bar)
         self.decide_branch()
 
+    def pad_batch(self, obs_batch):
+        '''
+            With CUDA graphs, pad the batch size to the next power of two by repeating the last sample,
+            so that the AIME iterations reuse a few captured graphs instead of capturing one per width.
+            Only pad when the network actually replays a graph (CUDA inputs, eval mode), otherwise the padded
+            samples are just wasted forward work
+        '''
+        replay_graph = self.use_cuda_graph and self.network.use_cuda_graph and not self.network.training \
+            and torch.device(self.device).type == 'cuda'
+        if not replay_graph:
+            return obs_batch
+        batch_size = 1 << (len(obs_batch) - 1).bit_length()
+        return obs_batch + [obs_batch[-1]] * (batch_size - len(obs_batch))
+
+    @torch.no_grad()
     def predict_scenes(self, data):
         data_in = self.network.pre_process(data)    # 对输入数据进行预处理
         return self.network(data_in)    # 通过网络模型进行场景预测
@@ -97,6 +126,7 @@ class ScenarioTreeGenerator:
             self.tree.add_node(new_node)
 
     def decide_branch(self):
+        branch_leaves = []
         # iterate over the leaf nodes
         for l in self.tree.get_leaf_nodes():
             if l.data.branch_flag:
@@ -108,14 +138,33 @@ class ScenarioTreeGenerator:
                 else:
                     t_b = self.get_branch_time(l.data.data)
                     if t_b < self.pred_len:
-                        # Update the observation data
-                        l.data.obs_data, l.data.data = self.update_obser(l.data.data)
                         # Add node to branch set
+                        branch_leaves.append(l)
                         l.data.branch_flag = True
                     else:
                         # Add node the end set
                         l.data.end_flag = True
 
+        # Update the observation data, the target lane commands of all new branch nodes are computed in one batch
+        for l, (obs_data, data) in zip(branch_leaves, self.update_obser_batch([l.data.data for l in branch_leaves])):
+            l.data.obs_data, l.data.data = obs_data, data
+
+    def update_obser_batch(self, cur_data_batch):
+        if len(cur_data_batch) == 0:
+            return []
+        # the new observation ends at END_T, take the ego state there as the origin, as update_obser does
+        origs, thetas, vels = [], [], []
+        for cur_data in cur_data_batch:
+            t_end = self.obs_len + cur_data["END_T"] - cur_data["CUR_T"]
+            origs.append(cur_data['TRAJS_POS_HIST'][0, :t_end][-1])
+            thetas.append(cur_data['TRAJS_ANG_HIST'][0, :t_end][-1])
+            vels.append(cur_data['TRAJS_VEL_HIST'][0, :t_end][-1])
+        thetas = torch.stack(thetas)
+        tgt_pts, tgt_nodes, (anch_pos, anch_vec) = self.get_high_level_command(
+            torch.stack(origs), build_rot2d(torch.cos(thetas), torch.sin(thetas)), torch.linalg.vector_norm(torch.stack(vels), dim=-1))
+        return [self.update_obser(cur_data, (tgt_pts[i], tgt_nodes[i], [anch_pos[i], anch_vec[i]]))
+                for i, cur_data in enumerate(cur_data_batch)]
+
     def get_branch_set(self):
         branch_set = []
         for l in self.tree.get_leaf_nodes():
@@ -125,16 +174,24 @@ class ScenarioTreeGenerator:
         return branch_set
 
     def set_target_lane(self, target_lane, target_lane_info):
-        self.target_lane = gpu(torch.from_numpy(np.array(target_lane)), self.device)
-        self.target_lane_info = torch.cat([torch.from_numpy(target_lane_info[0]).unsqueeze(1),
-                                           torch.from_numpy(target_lane_info[1]),
-                                           torch.from_numpy(target_lane_info[2]),
-                                           torch.from_numpy(target_lane_info[3]),
-                                           torch.from_numpy(target_lane_info[4]).unsqueeze(1),
-                                           torch.from_numpy(target_lane_info[5]).unsqueeze(1)],
-                                          dim=-1)  # [N_{lane}, 16, F]
-
-        self.target_lane_info = gpu(self.target_lane_info, self.device)
+        target_lane_info = np.concatenate([target_lane_info[0][:, None],
+                                           target_lane_info[1],
+                                           target_lane_info[2],
+                                           target_lane_info[3],
+                                           target_lane_info[4][:, None],
+                                           target_lane_info[5][:, None]], axis=-1)  # [N_{lane}, 16, F]
+
+        # points and info share one [N_{lane}, 2 + F] slab, so a single upload and a single gather serve both
+        # (the info ends up in the dtype of the points in tgt_nodes anyway)
+        target_lane = np.asarray(target_lane)
+        target_lane_full = np.concatenate([target_lane, target_lane_info.astype(target_lane.dtype)], axis=-1)
+        self._target_lane_full = gpu(torch.from_numpy(target_lane_full), self.device)
+        self.target_lane = self._target_lane_full[:, :2].contiguous()
+        self.target_lane_info = self._target_lane_full[:, 2:]
+        # cumulative arc length along the target lane, for locating the look-ahead point
+        seg_vec = self.target_lane[1:] - self.target_lane[:-1]
+        seg_len = torch.sqrt(torch.sum(seg_vec * seg_vec, dim=-1))
+        self._target_cumdist = torch.cat([seg_len.new_zeros(1), torch.cumsum(seg_len, dim=0)])
 
     def process_data(self, lcl_smp, agent_obs):
         """
@@ -168,26 +225,13 @@ class ScenarioTreeGenerator:
         trajs_ang = trajs_ang - theta_seq
         trajs_vel = torch.matmul(trajs_vel, rot_seq)
 
-        # 归一化轨迹数据
-        trajs_pos_norm = []
-        trajs_ang_norm = []
-        trajs_vel_norm = []
-        trajs_ctrs = []
-        trajs_vecs = []
-        for traj_pos, traj_ang, traj_vel in zip(trajs_pos, trajs_ang, trajs_vel):
-            orig_act, rot_act, theta_act = get_origin_rotation(traj_pos, traj_ang, self.device)
-            trajs_pos_norm.append(torch.matmul(traj_pos - orig_act, rot_act))
-            trajs_ang_norm.append(traj_ang - theta_act)
-            trajs_vel_norm.append(torch.matmul(traj_vel, rot_act))
-            trajs_ctrs.append(orig_act)
-            trajs_vecs.append(torch.tensor([torch.cos(theta_act), torch.sin(theta_act)]))
-
-        # 将归一化的轨迹数据堆叠起来
-        trajs_pos = torch.stack(trajs_pos_norm)  # [N, 110(50), 2]
-        trajs_ang = torch.stack(trajs_ang_norm)  # [N, 110(50)]
-        trajs_vel = torch.stack(trajs_vel_norm)  # [N, 110(50), 2]
-        trajs_ctrs = torch.stack(trajs_ctrs).to(self.device)  # [N, 2]
-        trajs_vecs = torch.stack(trajs_vecs).to(self.device)  # [N, 2]
+        # 归一化轨迹数据: 所有agent一次性批量变换到各自的局部坐标系
+        orig_act, rot_act, theta_act = get_origin_rotation_batched(trajs_pos, trajs_ang)
+        trajs_pos = torch.matmul(trajs_pos - orig_act.unsqueeze(1), rot_act)  # [N, 110(50), 2]
+        trajs_ang = trajs_ang - theta_act.unsqueeze(1)  # [N, 110(50)]
+        trajs_vel = torch.matmul(trajs_vel, rot_act)  # [N, 110(50), 2]
+        trajs_ctrs = orig_act  # [N, 2]
+        trajs_vecs = rot_act[..., 0]  # [N, 2], [cos, sin] of the heading
 
         # 创建一个字典来存储轨迹数据
         trajs = dict()
@@ -200,12 +244,17 @@ class ScenarioTreeGenerator:
         # anchor ctrs & vecs
         trajs["TRAJS_CTRS"] = trajs_ctrs
         trajs["TRAJS_VECS"] = trajs_vecs
+        # cached for the transforms back to the scene frame
+        trajs["TRAJS_ROTS"] = rot_act  # [N, 2, 2], first column is trajs_vecs
+        trajs["TRAJS_THETA"] = torch.atan2(trajs_vecs[:, 1], trajs_vecs[:, 0])  # [N]
         # track id & category
         trajs["TRAJS_TID"] = trajs_tid  # List[str]
         trajs["TRAJS_CAT"] = trajs_cat  # List[str]
 
         # 获取高层次命令
-        tgt_pts, tgt_nodes, tgt_anch = self.get_high_level_command(orig_seq, rot_seq, cur_vel)
+        tgt_pts, tgt_nodes, tgt_anch = self.get_high_level_command(orig_seq.unsqueeze(0), rot_seq.unsqueeze(0),
+                                                                   orig_seq.new_tensor([cur_vel]))
+        tgt_pts, tgt_nodes, tgt_anch = tgt_pts[0], tgt_nodes[0], [tgt_anch[0][0], tgt_anch[1][0]]
 
         # 计算相对位置误差
         lane_ctrs = lane_graph['lane_ctrs']
@@ -227,6 +276,7 @@ class ScenarioTreeGenerator:
         data = {}
         data["ORIG"] = orig_seq
         data["ROT"] = rot_seq
+        data["THETA_GLOBAL"] = torch.atan2(rot_seq[1, 0], rot_seq[0, 0])
         data["TRAJS"] = trajs
         data["LANE_GRAPH"] = lane_graph
         data["TGT_PTS"] = tgt_pts
@@ -237,7 +287,8 @@ class ScenarioTreeGenerator:
         data['TGT_ANCH'] = tgt_anch
         data['TGT_RPE'] = tgt_rpe
 
-        self.lane_graph = copy.deepcopy(data["LANE_GRAPH"])
+        # the lane graph is never modified in place (get_new_lane_graph builds new tensors), so keep the reference
+        self.lane_graph = data["LANE_GRAPH"]
         return gpu(collate_fn([data]), self.device)
 
     def get_scenario_tree(self):
@@ -251,41 +302,47 @@ class ScenarioTreeGenerator:
                 node.data.end_flag = True
                 node = self.tree.get_node(node.parent_key)
 
+        # gather the probabilities of all finished nodes with a single device to host transfer
+        end_keys = [key for key, node in self.tree.nodes.items() if node.parent_key is not None and node.data.end_flag]
+        scen_probs = dict()
+        if end_keys:
+            probs = torch.stack([self.tree.get_node(key).data.data["SCEN_PROB"] for key in end_keys]).cpu().tolist()
+            scen_probs = dict(zip(end_keys, probs))
+
         # construct the data_tree recursively and add normalized probability
         for key in root_node.children_keys:
             node = self.tree.get_node(key)
             if not node.data.end_flag:
                 continue
             data_tree.add_node(Node(node.key, root_node.key, [1.0]))
-            queue = [node]
+            queue = deque([node])
             while queue:
-                cur_node = queue.pop(0)
+                cur_node = queue.popleft()
                 parent_prob = data_tree.get_node(cur_node.key).data[0]
                 total_prob = 0.0
                 for child_key in cur_node.children_keys:
                     child_node = self.tree.get_node(child_key)
                     if child_node.data.end_flag:
-                        total_prob += child_node.data.data["SCEN_PROB"].cpu().numpy()
+                        total_prob += scen_probs[child_key]
 
                 for child_key in cur_node.children_keys:
                     child_node = self.tree.get_node(child_key)
                     if child_node.data.end_flag:
                         data_tree.add_node(Node(child_node.key, cur_node.key,
-                                                [child_node.data.data[
-                                                     "SCEN_PROB"].cpu().numpy() / total_prob * parent_prob]))
+                                                [scen_probs[child_key] / total_prob * parent_prob]))
                         queue.append(child_node)
 
-        # add traj, cov, tgt_lane to the data_tree
-        for node in self.get_end_set():
-            while node.parent_key is not None:
-                duration = node.data.data["END_T"] - node.data.data["CUR_T"]
-                data_node = data_tree.get_node(node.key)
-                if len(data_node.data) == 1:
-                    data_node.data += [
-                        node.data.data["TRAJS_POS_HIST"][:, self.obs_len: self.obs_len + duration, :].cpu().numpy(),
-                        node.data.data["TRAJS_COV_HIST"][:, self.obs_len: self.obs_len + duration, :].cpu().numpy(),
-                        node.data.data["TGT_PTS"].cpu().numpy()]
-                node = self.tree.get_node(node.parent_key)
+        # add traj, cov, tgt_lane to the data_tree, all finished nodes share a single device to host transfer
+        end_tensors = []
+        for key in end_keys:
+            node_data = self.tree.get_node(key).data.data
+            duration = node_data["END_T"] - node_data["CUR_T"]
+            end_tensors += [node_data["TRAJS_POS_HIST"][:, self.obs_len: self.obs_len + duration, :],
+                            node_data["TRAJS_COV_HIST"][:, self.obs_len: self.obs_len + duration, :],
+                            node_data["TGT_PTS"]]
+        end_arrays = to_numpy(end_tensors)
+        for i, key in enumerate(end_keys):
+            data_tree.get_node(key).data += end_arrays[3 * i: 3 * i + 3]
 
         #  separate the data_tree into trajectory trees from the root
         scenario_trees = []
@@ -295,9 +352,9 @@ class ScenarioTreeGenerator:
             node = data_tree.get_node(key)
             scenario_tree.add_node(Node(node.key, None, node.data))
             #  add the children nodes recursively and add normalized probability
-            queue = [node]
+            queue = deque([node])
             while queue:
-                cur_node = queue.pop(0)
+                cur_node = queue.popleft()
                 for child_key in cur_node.children_keys:
                     child_node = data_tree.get_node(child_key)
                     scenario_tree.add_node(Node(child_node.key, cur_node.key, child_node.data))
@@ -315,21 +372,75 @@ class ScenarioTreeGenerator:
 
     def prune_merge(self, data, out):
         data_interact = []
-        batch_size = len(data['ORIG'])
         res_cls_batch, res_reg_batch, res_aux_batch = out
+        batch_size = len(res_cls_batch)  # data may carry extra padded samples
 
+        # phase 1: queue the transforms and the pruning statistics of every sample on the device
+        trajs_all_batch = []
+        scene_stats_batch = []
         for idx in range(batch_size):
             orig = data['ORIG'][idx]
             rot = data['ROT'][idx]
+            theta_global = data['THETA_GLOBAL'][idx]
             trajs_ctrs = data['TRAJS'][idx]['TRAJS_CTRS']   # Trajectories Centers
-            trajs_vecs = data['TRAJS'][idx]['TRAJS_VECS']   # Trajectories Vectors
+            trajs_rots = data['TRAJS'][idx]['TRAJS_ROTS']   # Trajectories Rotations
+            trajs_theta = data['TRAJS'][idx]['TRAJS_THETA']     # Trajectories Headings
+
+            trajs_pos_hist = data['TRAJS_POS_HIST'][idx]    # Trajectories Position History
+            trajs_cov_hist = data['TRAJS_COV_HIST'][idx]    # Trajectories Coverage History
+
+            parent_prob = data['SCEN_PROB'][idx]    # Scenario Probability
+
+            # 提取并分离当前索引的回归、分类和速度结果
+            res_reg = res_reg_batch[idx].detach()
+            res_cls = res_cls_batch[idx].detach()
+            res_vel = res_aux_batch[idx][0].detach()
+            # 所有场景一次性转换到全局坐标系: 先从agent局部坐标系到场景坐标系，再到全局坐标系，两个旋转合并为一个
+            trajs_pos_all, trajs_vel_all, trajs_ang_all, trajs_cov_all = transform_scenes_to_global(
+                res_reg, res_vel, trajs_ctrs, trajs_rots, trajs_theta, orig, rot, theta_global, trajs_cov_hist[:, -1])  # [N, S, T, ...]
+
+            # 剪枝和合并所需的量先在GPU上对所有样本、所有场景批量计算, 再一次性拷贝到CPU上用NumPy完成筛选，避免逐样本同步
+            n_scene = res_cls.shape[1]
+            # 预测与历史拼接后截断到seq_len, 取截断后最后一个时刻在预测中的索引
+            t_last = min(self.seq_len - trajs_pos_hist.shape[1], trajs_pos_all.shape[2]) - 1
+            if self.target_lane is not None and self.ego_idx is not None:
+                ego_mean = trajs_pos_all[self.ego_idx, :, t_last]  # [S, 2]
+                ego_cov = trajs_cov_all[self.ego_idx, :, t_last, 0]  # [S]
+                ego_dev = get_distance_to_polyline_batched(self.target_lane, ego_mean) - ego_cov
+            else:
+                ego_dev = torch.zeros(n_scene, device=res_cls.device)
+
+            # cal the topo cum change for merging. 计算拓扑累积变化用于合并
+            # cal the cum angle change of the vector pointing from ego to the exo. 计算从 ego 到 exogenous 的向量的角度累积变化
+            vec = trajs_pos_all[1:] - trajs_pos_all[:1]  # [N - 1, S, T, 2]
+            vec = vec / torch.norm(vec, dim=-1, keepdim=True)
+            ang = torch.atan2(vec[..., 1], vec[..., 0])
+            ang_diff = ang[..., 1:] - ang[..., :-1]
+            # normalize the angle diff
+            ang_diff = torch.atan2(torch.sin(ang_diff), torch.cos(ang_diff))
+            topos = torch.sum(ang_diff, dim=-1).T  # [S, N - 1]
+
+            # [S, 3 + N - 1]
+            scene_stats = torch.cat([res_cls[0].unsqueeze(1),
+                                     (res_cls[0] * parent_prob).unsqueeze(1),
+                                     ego_dev.unsqueeze(1),
+                                     topos], dim=1)
+            trajs_all_batch.append((trajs_pos_all, trajs_vel_all, trajs_ang_all, trajs_cov_all))
+            scene_stats_batch.append(scene_stats)
+
+        # single device to host copy for the whole batch, so the kernels of all samples are queued before the only sync
+        stats_shapes = [stats.shape for stats in scene_stats_batch]
+        stats_flat = torch.cat([stats.reshape(-1) for stats in scene_stats_batch]).cpu().numpy()
+        stats_split = np.cumsum([stats.numel() for stats in scene_stats_batch])[:-1]
+        scene_stats_batch = [stats.reshape(shape) for stats, shape in zip(np.split(stats_flat, stats_split),
+                                                                          stats_shapes)]
+
+        # phase 2: prune and merge on the host, then build the data of the selected scenes
+        for idx in range(batch_size):
             trajs_type = data['TRAJS'][idx]["TRAJS_TYPE"]   # Trajectories Types
             trajs_tid = data['TRAJS'][idx]["TRAJS_TID"] # Trajectories ID
             trajs_cat = data['TRAJS'][idx]["TRAJS_CAT"] # Trajectories Category
 
-            # items in global frame
-            theta_global = torch.atan2(rot[1, 0], rot[0, 0])
-
             trajs_pos_hist = data['TRAJS_POS_HIST'][idx]    # Trajectories Position History
             trajs_ang_hist = data['TRAJS_ANG_HIST'][idx]    # Trajectories Angle History
             trajs_vel_hist = data['TRAJS_VEL_HIST'][idx]    # Trajectories Velocity History
@@ -340,60 +451,42 @@ class ScenarioTreeGenerator:
             cur_t = data['CUR_T'][idx]  # Current Time
             end_t = data['END_T'][idx]  # End Time
 
-            # 提取并分离当前索引的回归、分类和速度结果
-            res_reg = res_reg_batch[idx].detach()
             res_cls = res_cls_batch[idx].detach()
-            res_vel = res_aux_batch[idx][0].detach()
-            # 计算速度向量的角度
-            res_ang = get_angle(res_vel)
+            trajs_pos_all, trajs_vel_all, trajs_ang_all, trajs_cov_all = trajs_all_batch[idx]
+            scene_stats = scene_stats_batch[idx]
+            scene_cls, scene_probs, scene_devs, scene_topos = \
+                scene_stats[:, 0], scene_stats[:, 1], scene_stats[:, 2], scene_stats[:, 3:]
 
             # sort the scene by the probability. 根据概率对场景进行排序
-            scene_idcs = torch.argsort(res_cls, dim=1, descending=True)[0]
-
-            # 初始化数据候选列表
-            data_candidates = []
-
-            # 遍历排序后的场景索引
-            for scene_id in scene_idcs:
-                # 提取当前场景的概率
-                scene_prob = res_cls[0, scene_id]
-
-                # 构造场景ID
-                scen_id = "{}_{}_{}".format(self.branch_depth, idx, scene_id)
-
-                # 提取当前位置、协方差和速度的预测结果
-                trajs_pos_pred = res_reg[:, scene_id, :, :2]
-                # trajs_cov_pred = get_covariance_matrix(res_reg[:, scene_id, :, 2:])
-                trajs_cov_pred = get_max_covariance(res_reg[:, scene_id, :, 2:])  # use the max sigma
-                trajs_vel_pred = res_vel[:, scene_id]
-
-                # 计算轨迹的角度和旋转矩阵
-                trajs_theta = torch.atan2(trajs_vecs[:, 1], trajs_vecs[:, 0])
-                trajs_rots = torch.stack([torch.cos(trajs_theta), -torch.sin(trajs_theta),
-                                          torch.sin(trajs_theta), torch.cos(trajs_theta)], dim=1).view(-1, 2, 2)
+            scene_idcs = np.argsort(-scene_cls, kind='stable')
 
-                # 对每个轨迹进行坐标系对齐和位置偏移
-                for i in range(len(trajs_pos_pred)):
-                    trajs_pos_pred[i] = torch.matmul(trajs_pos_pred[i], trajs_rots[i].transpose(-1, -2)) + trajs_ctrs[i]
-                    trajs_vel_pred[i] = torch.matmul(trajs_vel_pred[i], trajs_rots[i].transpose(-1, -2))
-                    # trajs_cov_pred[i] = torch.matmul(trajs_rots[i],
-                    #                                  torch.matmul(trajs_cov_pred[i], trajs_rots[i].transpose(-1, -2)))
+            # prune if the scene is not likely, or the ego decision is not likely to follow the target lane.
+            # 忽略概率过低或自我决策偏离目标车道的场景
+            keep = ~(scene_probs[scene_idcs] < 0.001) & ~(scene_devs[scene_idcs] > self.config.tar_dist_thres)
+            data_candidates = scene_idcs[keep]
 
-                # 将预测结果转换到全局坐标系
-                trajs_pos_pred = torch.matmul(trajs_pos_pred, rot.T) + orig
-                trajs_vel_pred = torch.matmul(trajs_vel_pred, rot.T)
-                # trajs_cov_pred = torch.matmul(rot, torch.matmul(trajs_cov_pred, rot.T))
-
-                # 更新预测的角度
-                trajs_ang_pred = res_ang[:, scene_id] + trajs_theta.unsqueeze(1) + theta_global
-
-                trajs_cov_pred += trajs_cov_hist[:, -1].unsqueeze(1)
-
-                # 将预测结果与历史数据合并
-                trajs_pos_hist_new = torch.cat([trajs_pos_hist, trajs_pos_pred], dim=1)[:, :self.seq_len]
-                trajs_cov_hist_new = torch.cat([trajs_cov_hist, trajs_cov_pred], dim=1)[:, :self.seq_len]
-                trajs_ang_hist_new = torch.cat([trajs_ang_hist, trajs_ang_pred], dim=1)[:, :self.seq_len]
-                trajs_vel_hist_new = torch.cat([trajs_vel_hist, trajs_vel_pred], dim=1)[:, :self.seq_len]
+            # merge the similar scenes. 合并相似场景
+            min_topo_change = np.pi / 6  # delta
+            selected_idcs = data_candidates[greedy_topo_merge(scene_topos[data_candidates], min_topo_change)].tolist()
+
+            # 将预测结果与历史数据合并: 为所有保留下来的场景一次性分配长度为seq_len的缓冲区 [K, N, seq_len, ...],
+            # 先写入共同的历史, 再把各场景截断后的预测写入尾部
+            n_hist = trajs_pos_hist.shape[1]
+            n_pred = min(self.seq_len - n_hist, trajs_pos_all.shape[2])
+            scene_sel = torch.as_tensor(selected_idcs, dtype=torch.long, device=trajs_pos_all.device)
+            hist_new_all = []
+            for hist, pred in ((trajs_pos_hist, trajs_pos_all), (trajs_cov_hist, trajs_cov_all),
+                               (trajs_ang_hist, trajs_ang_all), (trajs_vel_hist, trajs_vel_all)):
+                hist_new = hist.new_empty((len(selected_idcs), hist.shape[0], n_hist + n_pred) + hist.shape[2:])
+                hist_new[:, :, :n_hist] = hist
+                hist_new[:, :, n_hist:] = pred[:, scene_sel, :n_pred].transpose(0, 1)
+                hist_new_all.append(hist_new)
+
+            # 只为保留下来的场景构造数据
+            selected_data = []
+            for k, scene_id in enumerate(selected_idcs):
+                trajs_pos_hist_new, trajs_cov_hist_new, trajs_ang_hist_new, trajs_vel_hist_new = \
+                    [hist_new[k] for hist_new in hist_new_all]
 
                 # 构造当前轨迹数据字典
                 cur_traj_data = dict()
@@ -403,61 +496,18 @@ class ScenarioTreeGenerator:
 
                 # 构造当前场景数据字典
                 cur_data = {}
-                cur_data["SCEN_PROB"] = scene_prob * parent_prob
+                cur_data["SCEN_PROB"] = res_cls[0, scene_id] * parent_prob
                 cur_data["CUR_T"] = cur_t
                 cur_data["END_T"] = end_t
                 cur_data["PARENT_ID"] = parent_id
-                cur_data["SCEN_ID"] = scen_id
+                cur_data["SCEN_ID"] = "{}_{}_{}".format(self.branch_depth, idx, scene_id)
                 cur_data["TRAJS"] = cur_traj_data
                 cur_data['TRAJS_POS_HIST'] = trajs_pos_hist_new
                 cur_data['TRAJS_COV_HIST'] = trajs_cov_hist_new
                 cur_data['TRAJS_ANG_HIST'] = trajs_ang_hist_new
                 cur_data['TRAJS_VEL_HIST'] = trajs_vel_hist_new
                 cur_data['TGT_PTS'] = data['TGT_PTS'][idx]
-
-                # prune if the scene is not likely. 如果场景概率过低，则忽略
-                if cur_data["SCEN_PROB"] < 0.001:
-                    continue
-
-                # prune if the ego decision is not likely to follow the target lane. 如果目标车道和自我索引存在，且自我决策偏离目标车道，则忽略
-                if self.target_lane is not None and self.ego_idx is not None:
-                    ego_mean = cur_data['TRAJS_POS_HIST'][self.ego_idx][-1]
-                    ego_cov = cur_data['TRAJS_COV_HIST'][self.ego_idx][-1]
-
-                    dis = get_distance_to_polyline(self.target_lane, ego_mean)
-                    if dis - ego_cov > self.config.tar_dist_thres:
-                        continue
-
-                # cal the topo cum change for merging. 计算拓扑累积变化用于合并
-                topos = torch.zeros(len(trajs_pos_pred) - 1)
-                for iii, traj in enumerate(trajs_pos_pred[1:]):
-                    # cal the cum angle change of the vector pointing from ego to the exo. 计算从 ego 到 exogenous 的向量的角度累积变化
-                    vec = traj - trajs_pos_pred[0]
-                    vec = vec / torch.norm(vec, dim=-1, keepdim=True)
-                    ang = torch.atan2(vec[:, 1], vec[:, 0])
-                    ang_diff = ang[1:] - ang[:-1]
-                    # normalize the angle diff
-                    ang_diff = torch.atan2(torch.sin(ang_diff), torch.cos(ang_diff))
-                    # cal the cum angle change of the vector pointing from ego to the exo
-                    topos[iii] = torch.sum(ang_diff)
-
-                # 将当前数据候选添加到列表中
-                data_candidates.append([cur_data, scene_prob, topos])
-
-            # merge the similar scenes. 合并相似场景
-            selected_data = []
-            min_topo_change = torch.pi / 6  # delta
-            while len(data_candidates) > 0:
-                select_data, select_prob, select_topos = data_candidates[0]
-                selected_data.append(select_data)
-                data_candidates_tmp = []
-                for data_candidate in data_candidates[1:]:
-                    _, _, res_topos = data_candidate
-                    topos_diff = select_topos - res_topos
-                    topos_diff = torch.atan2(torch.sin(topos_diff), torch.cos(topos_diff))
-                    if torch.sum((torch.abs(topos_diff) - min_topo_change) > 0) > 0:
-                        data_candidates_tmp.append(data_candidate)
-                data_candidates = data_candidates_tmp
+                selected_data.append(cur_data)
             data_interact += selected_data
 
         return data_interact
@@ -476,32 +526,24 @@ class ScenarioTreeGenerator:
         for idx in range(batch_size):
             orig = data['ORIG'][idx]
             rot = data['ROT'][idx]
+            theta_global = data['THETA_GLOBAL'][idx]
             trajs_ctrs = data['TRAJS'][idx]['TRAJS_CTRS']
-            trajs_vecs = data['TRAJS'][idx]['TRAJS_VECS']
-            theta_global = torch.atan2(rot[1, 0], rot[0, 0])
+            trajs_rots = data['TRAJS'][idx]['TRAJS_ROTS']
+            trajs_theta = data['TRAJS'][idx]['TRAJS_THETA']
 
             trajs_pos_obs = data['TRAJS'][idx]['TRAJS_POS_OBS']
             trajs_vel_obs = data['TRAJS'][idx]['TRAJS_VEL_OBS']
             trajs_ang_obs = get_angle(data['TRAJS'][idx]['TRAJS_ANG_OBS'])
 
-            trajs_theta = torch.atan2(trajs_vecs[:, 1], trajs_vecs[:, 0])
-            trajs_rots = torch.stack([torch.cos(trajs_theta), -torch.sin(trajs_theta),
-                                      torch.sin(trajs_theta), torch.cos(trajs_theta)], dim=1).view(-1, 2, 2).to(
-                self.device)
-
-            trajs_pos_hist = torch.empty_like(trajs_pos_obs)
-            trajs_vel_hist = torch.empty_like(trajs_vel_obs)
             # trajs_cov_hist = 1e-5 * torch.eye(2).unsqueeze(0).unsqueeze(0).repeat(len(trajs_pos_obs),
             #                                                                       len(trajs_pos_obs[0]), 1, 1).to(
             #     self.device)
             # print("trajs_cov_hist: ", trajs_cov_hist.shape)
-            trajs_cov_hist = 1e-5 * torch.ones((1,)).repeat(len(trajs_pos_obs), len(trajs_pos_obs[0]), 1).to(
-                self.device)
-            for i in range(len(trajs_pos_obs)):
-                trajs_pos_hist[i] = torch.matmul(trajs_pos_obs[i], trajs_rots[i].transpose(-1, -2)) + trajs_ctrs[i]
-                trajs_vel_hist[i] = torch.matmul(trajs_vel_obs[i], trajs_rots[i].transpose(-1, -2))
-                # trajs_cov_hist[i] = torch.matmul(trajs_rots[i],
-                #                                  torch.matmul(trajs_cov_hist[i], trajs_rots[i].transpose(-1, -2)))
+            trajs_cov_hist = torch.full((len(trajs_pos_obs), len(trajs_pos_obs[0]), 1), 1e-5, device=self.device)
+            trajs_pos_hist = torch.matmul(trajs_pos_obs, trajs_rots.transpose(-1, -2)) + trajs_ctrs.unsqueeze(1)
+            trajs_vel_hist = torch.matmul(trajs_vel_obs, trajs_rots.transpose(-1, -2))
+            # trajs_cov_hist = torch.matmul(trajs_rots.unsqueeze(1),
+            #                               torch.matmul(trajs_cov_hist, trajs_rots.transpose(-1, -2).unsqueeze(1)))
 
             trajs_pos_hist = torch.matmul(trajs_pos_hist, rot.T) + orig
             trajs_vel_hist = torch.matmul(trajs_vel_hist, rot.T)
@@ -515,7 +557,10 @@ class ScenarioTreeGenerator:
             data['TRAJS_COV_HIST'][idx] = trajs_cov_hist  # [N, 50, 1]
         return data
 
-    def update_obser(self, cur_data):
+    def update_obser(self, cur_data, tgt_cmd):
+        '''
+            tgt_cmd: (tgt_pts, tgt_nodes, tgt_anch) of this node, computed for all nodes at once in update_obser_batch
+        '''
         end_t = cur_data["END_T"]
         cur_t = cur_data["CUR_T"]
         duration = end_t - cur_t
@@ -524,7 +569,8 @@ class ScenarioTreeGenerator:
         cur_data['TRAJS_ANG_HIST'] = cur_data['TRAJS_ANG_HIST'][:, :self.obs_len + duration]
         cur_data['TRAJS_VEL_HIST'] = cur_data['TRAJS_VEL_HIST'][:, :self.obs_len + duration]
 
-        data = copy.deepcopy(cur_data)
+        # shallow copy, every entry that differs from cur_data is reassigned below rather than modified in place
+        data = dict(cur_data)
         data['CUR_T'] = end_t
         data['END_T'] = self.pred_len
         data['TRAJS_POS_HIST'] = data['TRAJS_POS_HIST'][:, -self.obs_len:]
@@ -552,24 +598,12 @@ class ScenarioTreeGenerator:
         trajs_vel = torch.matmul(trajs_vel, rot_seq)
 
         # ~ normalize trajs
-        trajs_pos_norm = []
-        trajs_ang_norm = []
-        trajs_vel_norm = []
-        trajs_ctrs = []
-        trajs_vecs = []
-        for traj_pos, traj_ang, traj_vel in zip(trajs_pos, trajs_ang, trajs_vel):
-            orig_act, rot_act, theta_act = get_origin_rotation(traj_pos, traj_ang, self.device)
-            trajs_pos_norm.append(torch.matmul(traj_pos - orig_act, rot_act))
-            trajs_ang_norm.append(traj_ang - theta_act)
-            trajs_vel_norm.append(torch.matmul(traj_vel, rot_act))
-            trajs_ctrs.append(orig_act)
-            trajs_vecs.append(torch.tensor([torch.cos(theta_act), torch.sin(theta_act)]))
-
-        trajs_pos_obs = torch.stack(trajs_pos_norm)  # [N, 110(50), 2]
-        trajs_ang_obs = torch.stack(trajs_ang_norm)  # [N, 110(50)]
-        trajs_vel_obs = torch.stack(trajs_vel_norm)  # [N, 110(50), 2]
-        trajs_ctrs = torch.stack(trajs_ctrs).to(self.device)  # [N, 2]
-        trajs_vecs = torch.stack(trajs_vecs).to(self.device)  # [N, 2]
+        orig_act, rot_act, theta_act = get_origin_rotation_batched(trajs_pos, trajs_ang)
+        trajs_pos_obs = torch.matmul(trajs_pos - orig_act.unsqueeze(1), rot_act)  # [N, 110(50), 2]
+        trajs_ang_obs = trajs_ang - theta_act.unsqueeze(1)  # [N, 110(50)]
+        trajs_vel_obs = torch.matmul(trajs_vel, rot_act)  # [N, 110(50), 2]
+        trajs_ctrs = orig_act  # [N, 2]
+        trajs_vecs = rot_act[..., 0]  # [N, 2], [cos, sin] of the heading
 
         trajs = dict()
         # observation
@@ -582,6 +616,9 @@ class ScenarioTreeGenerator:
         # anchor ctrs & vecs
         trajs["TRAJS_CTRS"] = trajs_ctrs
         trajs["TRAJS_VECS"] = trajs_vecs
+        # cached for the transforms back to the scene frame
+        trajs["TRAJS_ROTS"] = rot_act  # [N, 2, 2], first column is trajs_vecs
+        trajs["TRAJS_THETA"] = torch.atan2(trajs_vecs[:, 1], trajs_vecs[:, 0])  # [N]
         # track id & category
         trajs["TRAJS_TID"] = trajs_tid  # List[str]
         trajs["TRAJS_CAT"] = trajs_cat  # List[str]
@@ -598,7 +635,7 @@ class ScenarioTreeGenerator:
         rpes['scene'], rpes['scene_mask'] = get_rpe(scene_ctrs, scene_vecs)
 
         # ~ get target lane
-        tgt_pts, tgt_nodes, tgt_anch = self.get_high_level_command(orig_seq, rot_seq, trajs_vel_obs[0, -1].norm())
+        tgt_pts, tgt_nodes, tgt_anch = tgt_cmd
         # ~ calc rpe for tgt
         tgt_ctr, tgt_vec = tgt_anch
         tgt_ctrs = torch.cat([tgt_ctr.unsqueeze(0), trajs_ctrs[0].unsqueeze(0)])
@@ -607,6 +644,7 @@ class ScenarioTreeGenerator:
 
         data["ORIG"] = orig_seq
         data["ROT"] = rot_seq
+        data["THETA_GLOBAL"] = torch.atan2(rot_seq[1, 0], rot_seq[0, 0])
         data['TRAJS'] = trajs
         data["LANE_GRAPH"] = lane_graph
         data['RPE'] = rpes
@@ -618,108 +656,82 @@ class ScenarioTreeGenerator:
         return data, cur_data
 
     def is_condition_met(self, data):
-        cov_change_rate = 9
-        trajs_cov = data["TRAJS_COV_HIST"]
-        cur_t = data["CUR_T"]
-        end_t = data["END_T"]
-        compare_t = self.obs_len + cur_t
-
-        if cur_t == 0:
-            compare_t += 1
-
-        for t in range(cur_t + 1, end_t):
-            # only check even time step
-            if t % 2 == 1:
-                continue
-
-            # check if the covariance is changing too fast
-            # for max sigma
-            if torch.sum(trajs_cov[:, self.obs_len + t] / trajs_cov[:, compare_t] > cov_change_rate) > 0:
-                data["END_T"] = t
-                return False
-
+        t = self.get_cov_change_time(data)
+        if t is not None:
+            data["END_T"] = t
+            return False
         return True
 
     def get_branch_time(self, pred_data):
-        cov_change_rate = 9
-        trajs_cov = pred_data["TRAJS_COV_HIST"]
-        cur_t = pred_data["CUR_T"]
-        end_t = pred_data["END_T"]
+        t = self.get_cov_change_time(pred_data)
+        if t is not None:
+            pred_data["END_T"] = t
+            return t
+        return pred_data["END_T"]
+
+    def get_cov_change_time(self, data, cov_change_rate=9):
+        """
+        Find the first even time step in (CUR_T, END_T) at which the max sigma of any agent grows more than
+        cov_change_rate times w.r.t. the current time, all time steps are checked at once with a single sync.
+        Returns None if there is no such time step.
+        """
+        trajs_cov = data["TRAJS_COV_HIST"]
+        cur_t = data["CUR_T"]
+        end_t = data["END_T"]
         compare_t = self.obs_len + cur_t
 
         if cur_t == 0:
             compare_t += 1
 
-        for t in range(cur_t + 1, end_t):
-            # only check even time step to save computation
-            if t % 2 == 1:
-                continue
+        # only check even time step to save computation
+        t_start = cur_t + 1 + (cur_t + 1) % 2
+        if t_start >= end_t:
+            return None
 
-            # check if the covariance is changing too fast for max sigma
-            if torch.sum(trajs_cov[:, self.obs_len + t] / trajs_cov[:, compare_t] > cov_change_rate) > 0:
-                pred_data["END_T"] = t
-                return t
-        return end_t
+        # check if the covariance is changing too fast for max sigma
+        ratios = trajs_cov[:, self.obs_len + t_start:self.obs_len + end_t:2] / trajs_cov[:, compare_t:compare_t + 1]
+        changed = (ratios > cov_change_rate).flatten(2).any(dim=2).any(dim=0).cpu().numpy()  # [n_checked]
+        if not changed.any():
+            return None
+        return t_start + 2 * int(np.argmax(changed))
 
     def get_high_level_command(self, orig, rot, cur_vel, min_vel=0.5):
         """
-        根据当前状态和目标车道信息，生成高级行为命令。
+        根据当前状态和目标车道信息，生成高级行为命令。批量处理B个节点, 不需要同步到CPU。
 
         参数:
-        - orig: 起始点坐标
-        - rot: 旋转矩阵，用于坐标转换
-        - cur_vel: 当前速度
+        - orig: 起始点坐标 [B, 2]
+        - rot: 旋转矩阵，用于坐标转换 [B, 2, 2]
+        - cur_vel: 当前速度 [B]
         - min_vel: 最小速度，默认值为0.5
 
         返回:
-        - tgt_pts: 目标车道点列表
-        - tgt_nodes: 目标节点信息，包含中心点、向量和车道信息
-        - tgt_anch: 目标锚点和向量
+        - tgt_pts: 目标车道点列表 [B, TGT_WIN, 2]
+        - tgt_nodes: 目标节点信息，包含中心点、向量和车道信息 [B, TGT_WIN - 1, F]
+        - tgt_anch: 目标锚点和向量 [B, 2], [B, 2]
         """
+        n_pts = len(self.target_lane)
+        assert n_pts >= TGT_WIN
 
-        # get tgt lane: 计算目标车道上每一点到起始点的距离
-        dists = torch.norm(self.target_lane - orig, dim=-1)
+        # get tgt lane: 计算目标车道上每一点到起始点的距离 (只用于argmin, 平方距离即可, 无需开方)
+        diffs = self.target_lane.unsqueeze(0) - orig.unsqueeze(1)  # [B, K, 2]
+        dists_sq = torch.sum(diffs * diffs, dim=-1)
         # get the closest target lane point: 找到距离最近的目标车道点索引
-        closest_idx = torch.argmin(dists)
+        closest_idx = torch.argmin(dists_sq, dim=1)
         # 根据当前速度和预测时间计算将要行驶的距离
-        travel_dist = max(cur_vel, min_vel) * self.config.tar_time_ahead
-        # get approximation of the future area idx: 初始化目标点索引为最近点索引
-        target_idx = closest_idx
-        # 根据行驶距离调整目标点索引
-        while target_idx < len(self.target_lane) - 1 and travel_dist > 0:
-            target_idx += 1
-            travel_dist -= torch.norm(self.target_lane[target_idx] - self.target_lane[target_idx - 1])
-
-        # 确保目标点索引不在车道的最后五个点内
-        if target_idx == len(self.target_lane) - 1:
-            target_idx -= 1
-        target_idx = max(5, min(target_idx, len(self.target_lane) - 6))
-
-        # 选取目标车道点及其信息
-        selected_idx = torch.arange(target_idx - 5, target_idx + 6)
-        target_lane_pts = self.target_lane[selected_idx]
-        target_lane_info = self.target_lane_info[selected_idx][1:]
-
-        tgt_pts = copy.deepcopy(target_lane_pts)
-        assert len(target_lane_pts) == 11
-
-        # 复制并转换目标车道点到局部坐标系
-        ctrln = copy.deepcopy(target_lane_pts)  # [num_sub_segs + 1, 2]
-        ctrln = torch.matmul(ctrln - orig, rot) # to local frame
-
-        # 计算锚点位置和向量
-        anch_pos = torch.mean(ctrln, dim=0)
-        anch_vec = (ctrln[-1] - ctrln[0]) / torch.norm(ctrln[-1] - ctrln[0])
-        anch_rot = torch.tensor([[anch_vec[0], -anch_vec[1]],
-                                 [anch_vec[1], anch_vec[0]]]).to(self.device)
-        ctrln = torch.matmul(ctrln - anch_pos, anch_rot)    # to instance frame
-
-        # 计算中心点和向量
-        ctrs = (ctrln[:-1] + ctrln[1:]) / 2.0
-        vecs = ctrln[1:] - ctrln[:-1]
+        travel_dist = torch.clamp(cur_vel, min=min_vel) * self.config.tar_time_ahead
+        # get approximation of the future area idx: 沿累积弧长二分查找第一个行驶距离不小于travel_dist的点
+        target_idx = torch.searchsorted(self._target_cumdist, self._target_cumdist[closest_idx] + travel_dist)
+        # 确保目标点索引不在车道的前后五个点内, 这个上界同时覆盖了超出车道末端和落在最后一个点上的情况
+        target_idx = target_idx.clamp_(min=TGT_HALF_WIN, max=n_pts - TGT_HALF_WIN - 1)
+
+        # 选取目标车道点及其信息: [B, TGT_WIN]
+        selected_idx = target_idx.unsqueeze(1) + torch.arange(-TGT_HALF_WIN, TGT_HALF_WIN + 1, device=target_idx.device)
+        target_lane_window = self._target_lane_full[selected_idx]  # [B, TGT_WIN, 2 + F]
+        tgt_pts = target_lane_window[..., :2]
+        target_lane_info = target_lane_window[:, 1:, 2:]
+
+        # 目标车道点先转换到局部坐标系, 再转换到锚点坐标系, 并构造目标节点特征 (均为out-of-place, 无需复制)
+        tgt_nodes, anch_pos, anch_vec = get_tgt_nodes(tgt_pts, target_lane_info, orig, rot)
         tgt_anch = [anch_pos, anch_vec]
-
-        # convert to tensor: 合并目标节点信息
-        # ~ calc tgt feat
-        tgt_nodes = torch.cat([ctrs, vecs, target_lane_info], dim=-1)   # [N_{lane}, 16, F]
         return tgt_pts, tgt_nodes, tgt_anch
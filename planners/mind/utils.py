@@ -1,7 +1,6 @@
 import torch
-import copy
 import numpy as np
-from typing import List, Any, Dict
+from typing import List, Any, Dict, Tuple
 from shapely.geometry import LineString
 from av2.map.lane_segment import LaneType, LaneMarkType
 from av2.datasets.motion_forecasting.data_schema import ObjectType
@@ -10,17 +9,69 @@ def gpu(data, device):
     """
     Transfer tensor in `data` to gpu recursively
     `data` can be dict, list or tuple
+    CPU tensors are packed per dtype into one pinned staging buffer, so each dtype needs a single H2D copy
     """
+    if isinstance(data, torch.Tensor):
+        return data.contiguous().to(device, non_blocking=True)
+    if torch.device(device).type != 'cuda':
+        return _gpu(data, device)
+
+    # collect the cpu tensors and coalesce them by dtype
+    groups = {}
+    _collect_cpu_tensors(data, groups)
+    staged = {}
+    for dtype, tensors in groups.items():
+        numels = [t.numel() for t in tensors]
+        staging = torch.empty(sum(numels), dtype=dtype, pin_memory=True)
+        torch.cat([t.reshape(-1) for t in tensors], out=staging)
+        chunks = staging.to(device, non_blocking=True).split(numels)
+        for t, chunk in zip(tensors, chunks):
+            staged[id(t)] = chunk.view(t.shape)
+    return _gpu(data, device, staged)
+
+
+def _collect_cpu_tensors(data, groups):
+    if isinstance(data, list) or isinstance(data, tuple):
+        for x in data:
+            _collect_cpu_tensors(x, groups)
+    elif isinstance(data, dict):
+        for _data in data.values():
+            _collect_cpu_tensors(_data, groups)
+    elif isinstance(data, torch.Tensor) and data.device.type == 'cpu':
+        groups.setdefault(data.dtype, []).append(data)
+
+
+def _gpu(data, device, staged=None):
     if isinstance(data, list) or isinstance(data, tuple):
-        data = [gpu(x, device=device) for x in data]
+        data = [_gpu(x, device, staged) for x in data]
     elif isinstance(data, dict):
-        data = {key: gpu(_data, device=device) for key, _data in data.items()}
+        data = {key: _gpu(_data, device, staged) for key, _data in data.items()}
     elif isinstance(data, torch.Tensor):
-        data = data.contiguous().to(device, non_blocking=True)
+        if staged is not None and id(data) in staged:
+            data = staged[id(data)]
+        else:
+            data = data.contiguous().to(device, non_blocking=True)
     return data
 
 
 
+def to_numpy(tensors):
+    """
+    Transfer a list of tensors to numpy arrays
+    tensors are packed per dtype, so each dtype needs a single D2H copy
+    """
+    groups = {}
+    for t in tensors:
+        groups.setdefault(t.dtype, []).append(t)
+    arrays = {}
+    for dtype, group in groups.items():
+        flat = torch.cat([t.reshape(-1) for t in group]).cpu().numpy()
+        numels = np.cumsum([t.numel() for t in group])[:-1]
+        for t, array in zip(group, np.split(flat, numels)):
+            arrays[id(t)] = array.reshape(tuple(t.shape))
+    return [arrays[id(t)] for t in tensors]
+
+
 def from_numpy(data):
     """Recursively transform numpy.ndarray to torch.Tensor.
     """
@@ -86,6 +137,7 @@ def graph_gather(batch_size, graphs):
             lane_vecs           torch.Size([116, 2])
             num_nodes           1160
             num_lanes           116
+            lane_feats          torch.Size([116, N_{pt}, F]), cached by get_lane_feats
     '''
     lane_idcs = list()
     lane_count = 0
@@ -94,23 +146,28 @@ def graph_gather(batch_size, graphs):
         lane_idcs.append(l_idcs)
         lane_count = lane_count + graphs[i]["num_lanes"]
 
-    graph = dict()
-    for key in ["node_ctrs", "node_vecs", "intersect", "lane_type", "cross_left", "cross_right", "left", "right"]:
-        graph[key] = torch.cat([x[key] for x in graphs], 0)
-    for key in ["lane_ctrs", "lane_vecs"]:
-        graph[key] = [x[key] for x in graphs]
-
-    lanes = torch.cat([graph['node_ctrs'],
-                       graph['node_vecs'],
-                       graph['intersect'].unsqueeze(2),
-                       graph['lane_type'],
-                       graph['cross_left'],
-                       graph['cross_right'],
-                       graph['left'].unsqueeze(2),
-                       graph['right'].unsqueeze(2)], dim=-1)  # [N_{lane}, 9, F]
+    lanes = torch.cat([get_lane_feats(x) for x in graphs], dim=0)  # [N_{lane}, 9, F]
     return lanes, lane_idcs
 
 
+def get_lane_feats(graph):
+    '''
+        lane node features of a single graph, cached on the graph dict under 'lane_feats'
+        the features only use the lane-frame entries, so the cache stays valid after get_new_lane_graph
+        (it only re-transforms lane_ctrs and lane_vecs), and all nodes of a scenario tree share it
+    '''
+    if 'lane_feats' not in graph:
+        graph['lane_feats'] = torch.cat([graph['node_ctrs'],
+                                         graph['node_vecs'],
+                                         graph['intersect'].unsqueeze(2),
+                                         graph['lane_type'],
+                                         graph['cross_left'],
+                                         graph['cross_right'],
+                                         graph['left'].unsqueeze(2),
+                                         graph['right'].unsqueeze(2)], dim=-1)  # [N_{lane}, 9, F]
+    return graph['lane_feats']
+
+
 def actor_gather(batch_size, trajs):
     num_actors = [len(x['TRAJS_CTRS']) for x in trajs]
 
@@ -169,7 +226,8 @@ def collate_fn(batch: List[Any]) -> Dict[str, Any]:
 
 
 def get_new_lane_graph(lane_graph, orig, rot, device):
-    ret_lane_graph = gpu(copy.deepcopy(lane_graph), device=device)
+    # gpu() returns a new dict, the transformed entries below are new tensors, the rest is shared with lane_graph
+    ret_lane_graph = gpu(lane_graph, device=device)
     # transform the lane_ctrs and lane_vecs
     ret_lane_graph['lane_ctrs'] = torch.matmul(ret_lane_graph['lane_ctrs'] - orig, rot)
     ret_lane_graph['lane_vecs'] = torch.matmul(ret_lane_graph['lane_vecs'], rot)
@@ -182,14 +240,33 @@ def get_origin_rotation(traj_pos, traj_ang, device):
     orig = traj_pos[obs_len - 1]
     theta = traj_ang[obs_len - 1]
     if isinstance(orig, torch.Tensor):
-        rot = torch.tensor([[torch.cos(theta), -torch.sin(theta)],
-                            [torch.sin(theta), torch.cos(theta)]]).to(device)
+        rot = build_rot2d(torch.cos(theta), torch.sin(theta))
     elif isinstance(orig, np.ndarray):
         rot = np.array([[np.cos(theta), -np.sin(theta)],
                         [np.sin(theta), np.cos(theta)]])
     return orig, rot, theta
 
 
+def get_origin_rotation_batched(trajs_pos, trajs_ang):
+    ''' input: [N, T, 2], [N, T]
+        output: [N, 2], [N, 2, 2], [N]
+        batched torch version of get_origin_rotation, one frame per trajectory
+    '''
+    obs_len = 50
+    orig = trajs_pos[:, obs_len - 1]
+    theta = trajs_ang[:, obs_len - 1]
+    rot = build_rot2d(torch.cos(theta), torch.sin(theta))
+    return orig, rot, theta
+
+
+def build_rot2d(cos_theta, sin_theta):
+    ''' input: [...], [...]
+        output: [..., 2, 2], [[cos, -sin], [sin, cos]]
+        the first column of the rotation is the heading vector [cos, sin]
+    '''
+    return torch.stack([cos_theta, -sin_theta, sin_theta, cos_theta], dim=-1).reshape(*cos_theta.shape, 2, 2)
+
+
 def get_rpe(ctrs, vecs, radius=100.0):
     # distance encoding
     d_pos = (ctrs.unsqueeze(0) - ctrs.unsqueeze(1)).norm(dim=-1)
@@ -513,6 +590,92 @@ def get_distance_to_polyline(polyline, point):
     return min_distance
 
 
+def get_distance_to_polyline_batched(polyline, points):
+    ''' input: [K, 2], [S, 2]
+        output: [S]
+        batched version of get_distance_to_polyline, all points against all segments at once
+    '''
+    p1, p2 = polyline[:-1], polyline[1:]  # [K - 1, 2]
+    segment_vector = p2 - p1
+    # zero-length segments (repeated lane points) would give 0 / 0, guard them so they reduce to their start point
+    projected_vector = torch.sum((points.unsqueeze(1) - p1) * segment_vector, dim=-1) / \
+        torch.sum(segment_vector * segment_vector, dim=-1).clamp_min(1e-12)  # [S, K - 1]
+    t = torch.clamp(torch.nan_to_num(projected_vector, nan=0.0), 0, 1)
+    closest = p1 + t.unsqueeze(-1) * segment_vector  # [S, K - 1, 2]
+    distance = torch.linalg.vector_norm(closest - points.unsqueeze(1), dim=-1)
+    return torch.min(distance, dim=-1)[0]
+
+
+@torch.jit.script
+def transform_scenes_to_global(res_reg: torch.Tensor, res_vel: torch.Tensor, trajs_ctrs: torch.Tensor,
+                               trajs_rots: torch.Tensor, trajs_theta: torch.Tensor, orig: torch.Tensor,
+                               rot: torch.Tensor, theta_global: torch.Tensor,
+                               cov_last: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    ''' input: [N, S, T, 5], [N, S, T, 2], [N, 2], [N, 2, 2], [N], [2], [2, 2], [], [N, 1]
+        output: [N, S, T, 2], [N, S, T, 2], [N, S, T], [N, S, T, 1]
+        agent frame -> scene frame -> global frame for all scenes at once, the two rotations are fused into one
+    '''
+    trajs_rots_global = torch.matmul(trajs_rots.transpose(-1, -2), rot.t()).unsqueeze(1)  # [N, 1, 2, 2]
+    trajs_ctrs_global = (torch.matmul(trajs_ctrs, rot.t()) + orig).unsqueeze(1).unsqueeze(1)  # [N, 1, 1, 2]
+
+    trajs_pos = torch.matmul(res_reg[..., :2], trajs_rots_global) + trajs_ctrs_global
+    trajs_vel = torch.matmul(res_vel, trajs_rots_global)
+    trajs_ang = torch.atan2(res_vel[..., 1], res_vel[..., 0]) + trajs_theta.view(-1, 1, 1) + theta_global
+    # use the max sigma
+    trajs_cov = torch.maximum(res_reg[..., 2], res_reg[..., 3]).unsqueeze(-1) + cov_last.view(-1, 1, 1, 1)
+    return trajs_pos, trajs_vel, trajs_ang, trajs_cov
+
+
+@torch.jit.script
+def get_tgt_nodes(target_lane_pts: torch.Tensor, target_lane_info: torch.Tensor, orig: torch.Tensor,
+                  rot: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    ''' input: [B, K + 1, 2], [B, K, F], [B, 2], [B, 2, 2]
+        output: [B, K, 4 + F], [B, 2], [B, 2]
+        target lane windows -> local frame -> instance frame, batched over B windows and scripted since the
+        tensors are tiny and the eager version is dominated by the per-op dispatch
+    '''
+    # anchor position and heading in the local frame
+    # exact mean (the window is not always straight), with the 1 / (K + 1) folded into a scalar multiply
+    pts_mean = torch.sum(target_lane_pts, dim=1) * (1.0 / target_lane_pts.shape[1])  # [B, 2]
+    anch_dir = target_lane_pts[:, -1] - target_lane_pts[:, 0]
+    anch_dir = anch_dir * torch.rsqrt(torch.sum(anch_dir * anch_dir, dim=-1, keepdim=True))  # global frame
+    anch = torch.matmul(torch.stack([pts_mean - orig, anch_dir], dim=1), rot)  # [B, 2, 2], to local frame
+    anch_pos, anch_vec = anch[:, 0], anch[:, 1]
+
+    # global -> instance frame in one rotation, the translation cancels out once the points are centered on their mean.
+    # 2D rotations commute, so rot @ anch_rot is simply the rotation of the global-frame heading anch_dir
+    rot_inst = torch.stack([anch_dir[:, 0], -anch_dir[:, 1], anch_dir[:, 1], anch_dir[:, 0]], dim=-1).view(-1, 1, 2, 2)
+    pts = target_lane_pts - pts_mean.unsqueeze(1)
+    # [B, K, 2, 2], ctrs and vecs, written in place: vecs = b - a, then ctrs = a + 0.5 * vecs
+    segs = pts.new_empty((pts.shape[0], pts.shape[1] - 1, 2, 2))
+    torch.sub(pts[:, 1:], pts[:, :-1], out=segs[:, :, 1])
+    torch.add(pts[:, :-1], segs[:, :, 1], alpha=0.5, out=segs[:, :, 0])
+
+    # write ctrs, vecs and the lane info straight into the node features
+    tgt_nodes = pts.new_empty((segs.shape[0], segs.shape[1], 4 + target_lane_info.shape[-1]))
+    tgt_nodes[:, :, :4] = torch.matmul(segs, rot_inst).reshape(segs.shape[0], segs.shape[1], 4)
+    tgt_nodes[:, :, 4:] = target_lane_info
+    return tgt_nodes, anch_pos, anch_vec
+
+
+def greedy_topo_merge(topos, min_change):
+    ''' input: [C, N - 1], sorted by priority
+        output: [C], True for the kept scenes
+        pairwise topology differences in one broadcast, then greedily keep a scene and merge every scene similar to it
+    '''
+    topos_diff = topos[:, None] - topos[None, :]  # [C, C, N - 1]
+    topos_diff = np.arctan2(np.sin(topos_diff), np.cos(topos_diff))
+    similar = ~np.any(np.abs(topos_diff) > min_change, axis=-1)  # [C, C]
+    kept = np.zeros(len(topos), dtype=bool)
+    merged = np.zeros(len(topos), dtype=bool)
+    for i in range(len(topos)):
+        if merged[i]:
+            continue
+        kept[i] = True
+        merged |= similar[i]
+    return kept
+
+
 def get_covariance_matrix(data):
     # check is torch or numpy
     if isinstance(data, torch.Tensor):